@@ -0,0 +1,137 @@
+import errno
+import hashlib
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+
+import simplejson as json
+from typing import Union
+
+from util import io
+
+
+class AudioCache(object):
+    """
+    Content-addressed on-disk cache of synthesized audio.
+
+    Each entry is keyed by a hash of (text, voice, encoding)
+    and stored sharded by its key as `root`/ab/cd/abcd....`encoding`.
+    A small SQLite index in `root` records each entry's size and hits.
+
+    When the entries exceed `max_size` bytes, the least-recently-hit ones are evicted.
+    
+    :ivar root: directory of the cache
+    :type root: str
+    
+    :ivar max_size: max total bytes of the entries, or None for unbounded
+    :type max_size: int
+    """
+
+    INDEX_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS entries(
+        key TEXT PRIMARY KEY,
+        encoding TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        created REAL NOT NULL,
+        last_hit REAL,
+        hits INTEGER NOT NULL DEFAULT 0
+    )'''
+
+    def __init__(self, root='data/audio_cache', max_size=None):
+        # type: (str, int) -> None
+        self.root = root
+        self.max_size = max_size
+        self._index_path = os.path.join(root, 'index.db')
+
+    @staticmethod
+    def key(text, voice, encoding):
+        # type: (unicode, str, str) -> str
+        """Hash what determines the synthesized audio."""
+        return hashlib.sha1(json.dumps([text, voice, encoding])).hexdigest()
+
+    def path(self, key, encoding):
+        # type: (str, str) -> str
+        """Get the path of the entry for `key`, whether or not it exists."""
+        return os.path.join(self.root, key[:2], key[2:4], '{}.{}'.format(key, encoding))
+
+    def _index(self):
+        # type: () -> sqlite3.Connection
+        io.mkdir_if_not_exists(self.root)
+        conn = sqlite3.connect(self._index_path, timeout=5.0)
+        conn.execute(AudioCache.INDEX_SCHEMA)
+        return conn
+
+    def get(self, key, encoding):
+        # type: (str, str) -> Union[str, None]
+        """Get the path of the cached audio for `key`, or None if it isn't cached."""
+        path = self.path(key, encoding)
+        if not os.path.exists(path):
+            return None
+        conn = self._index()
+        try:
+            with conn:
+                conn.execute('UPDATE entries SET last_hit = ?, hits = hits + 1 WHERE key = ?',
+                             [time.time(), key])
+        finally:
+            conn.close()
+        return path
+
+    def put(self, key, encoding, audio):
+        # type: (str, str, str) -> str
+        """Cache `audio` under `key` and return its path."""
+        path = self.path(key, encoding)
+        dir_path = os.path.dirname(path)
+        io.mkdir_if_not_exists(dir_path)
+        # write to a temp file first so a half-written entry is never visible
+        fd, temp_path = tempfile.mkstemp(dir=dir_path)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(audio)
+            os.rename(temp_path, path)
+        except:
+            io.remove_if_exists(temp_path)
+            raise
+        conn = self._index()
+        try:
+            with conn:
+                conn.execute('INSERT OR REPLACE INTO entries (key, encoding, size, created) '
+                             'VALUES (?, ?, ?, ?)',
+                             [key, encoding, len(audio), time.time()])
+                self._evict(conn, keep=key)
+        finally:
+            conn.close()
+        return path
+    
+    def _evict(self, conn, keep):
+        # type: (sqlite3.Connection, str) -> None
+        """Evict the least-recently-hit entries, except `keep`, until within `max_size`."""
+        if self.max_size is None:
+            return
+        size, = conn.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()
+        if size <= self.max_size:
+            return
+        evicted = []
+        for key, encoding, entry_size in conn.execute(
+                'SELECT key, encoding, size FROM entries WHERE key != ? '
+                'ORDER BY COALESCE(last_hit, created)', [keep]):
+            if size <= self.max_size:
+                break
+            # files hardlinked from the cache stay until they're evicted from their store too
+            io.remove_if_exists(self.path(key, encoding))
+            evicted.append((key,))
+            size -= entry_size
+        conn.executemany('DELETE FROM entries WHERE key = ?', evicted)
+
+    @staticmethod
+    def link(cached_path, path):
+        # type: (str, str) -> None
+        """Make `path` a hardlink to `cached_path`, or a copy if hardlinks aren't possible."""
+        io.remove_if_exists(path)
+        try:
+            os.link(cached_path, path)
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+                raise
+            shutil.copyfile(cached_path, path)
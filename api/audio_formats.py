@@ -0,0 +1,30 @@
+import os
+
+from typing import Dict
+
+# Watson Text to Speech accept types by file extension
+accept_types = {
+    'wav': 'audio/wav',
+    'ogg': 'audio/ogg;codecs=opus',
+    'mp3': 'audio/mp3',
+    'flac': 'audio/flac',
+}  # type: Dict[str, str]
+
+# browser MIME types by file extension
+mime_types = {
+    'wav': 'audio/wav',
+    'ogg': 'audio/ogg',
+    'mp3': 'audio/mpeg',
+    'flac': 'audio/flac',
+}  # type: Dict[str, str]
+
+# short question prompts compress best with Opus,
+# long song lyrics use MP3, which plays everywhere and can be concatenated
+QUESTION_ENCODING = 'ogg'  # type: str
+SONG_ENCODING = 'mp3'  # type: str
+
+
+def mime_type(path):
+    # type: (str) -> str
+    """Get the browser MIME type of the audio file at `path`."""
+    return mime_types.get(os.path.splitext(path)[1][1:], 'application/octet-stream')
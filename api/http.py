@@ -0,0 +1,235 @@
+"""
+Shared outbound HTTP layer used by all the external APIs.
+
+All requests go through one `requests.Session`, which keeps a pool of keep-alive connections
+per host, with per-API rate limits, timeouts, bounded retries with jittered exponential backoff,
+and metrics per endpoint.
+"""
+
+import random
+import threading
+import time
+from urlparse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from typing import Any, Dict, List, Tuple
+
+from api import rate_limit
+from api.rate_limit import TokenBucket
+from util.lazy import ProcessLocal
+
+
+class Api(object):
+    """
+    HTTP settings of an external API.
+
+    :ivar name: name of the API in metrics
+    :type name: str
+
+    :ivar connect_timeout: seconds to wait for a connection
+    :type connect_timeout: float
+
+    :ivar read_timeout: seconds to wait for the server between bytes of the response
+    :type read_timeout: float
+
+    :ivar max_retries: max times a failed request is retried
+    :type max_retries: int
+
+    :ivar backoff: seconds before the first retry, doubling each retry (before jitter)
+    :type backoff: float
+
+    :ivar max_backoff: max seconds between retries (before jitter)
+    :type max_backoff: float
+
+    :ivar rate_limit: limit on requests (including retries) matching the API's quota, or None
+    :type rate_limit: TokenBucket
+    """
+
+    def __init__(self, name, connect_timeout=3.05, read_timeout=10.0, max_retries=2,
+                 backoff=0.5, max_backoff=8.0, rate_limit=None):
+        # type: (str, float, float, int, float, float, TokenBucket) -> None
+        self.name = name
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.rate_limit = rate_limit
+
+    def backoff_time(self, retry):
+        # type: (int) -> float
+        """Seconds to wait before the `retry`th retry, with full jitter."""
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** retry))
+
+
+# Open Trivia allows one request every 5 seconds per IP
+TRIVIA = Api('trivia', rate_limit=TokenBucket(1 / 5.0))
+# the free Musixmatch plan allows 2000 requests a day
+MUSIXMATCH = Api('musixmatch', rate_limit=TokenBucket(2000 / (24 * 60 * 60.0), burst=100,
+                                                      foreground_reserve=20))
+# synthesizing long text can take a while
+WATSON = Api('watson', read_timeout=60.0, rate_limit=TokenBucket(10, burst=10,
+                                                                  foreground_reserve=4))
+
+APIS = [TRIVIA, MUSIXMATCH, WATSON]  # type: List[Api]
+
+
+def share_rate_limits(num_processes):
+    # type: (int) -> None
+    """
+    Lower this process's rate limits to its share of the APIs' quotas,
+    when `num_processes` processes are making requests.
+    """
+    for api in APIS:
+        if api.rate_limit is not None:
+            api.rate_limit.share(num_processes)
+
+
+# responses that may succeed if retried
+RETRY_STATUSES = frozenset([429, 500, 502, 503, 504])
+
+# number of hosts to keep connection pools for
+POOL_CONNECTIONS = 8  # type: int
+# max connections kept alive per host
+POOL_MAX_SIZE = 16  # type: int
+
+
+def _create_session():
+    # type: () -> requests.Session
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAX_SIZE)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+# connections can't be shared across processes, so each process has its own session
+session = ProcessLocal(_create_session)  # type: requests.Session
+
+
+class _EndpointStats(object):
+    """Request counts and times of one endpoint."""
+
+    def __init__(self):
+        # type: () -> None
+        self.requests = 0
+        self.retries = 0
+        self.failures = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.throttled_time = 0.0
+
+    def as_dict(self):
+        # type: () -> Dict[str, Any]
+        return dict(
+                requests=self.requests,
+                retries=self.retries,
+                failures=self.failures,
+                total_time=self.total_time,
+                avg_time=self.total_time / self.requests if self.requests else 0.0,
+                max_time=self.max_time,
+                throttled_time=self.throttled_time,
+        )
+
+
+_stats = {}  # type: Dict[Tuple[str, str, str], _EndpointStats]
+_stats_lock = threading.Lock()
+
+
+def _endpoint_stats(endpoint):
+    # type: (Tuple[str, str, str]) -> _EndpointStats
+    """Get the stats of `endpoint`.  Must hold `_stats_lock`."""
+    stats = _stats.get(endpoint)
+    if stats is None:
+        stats = _stats[endpoint] = _EndpointStats()
+    return stats
+
+
+def _record_throttled(endpoint, throttled_time):
+    # type: (Tuple[str, str, str], float) -> None
+    with _stats_lock:
+        _endpoint_stats(endpoint).throttled_time += throttled_time
+
+
+def _record(endpoint, request_time, retried, failed):
+    # type: (Tuple[str, str, str], float, bool, bool) -> None
+    with _stats_lock:
+        stats = _endpoint_stats(endpoint)
+        stats.requests += 1
+        stats.retries += retried
+        stats.failures += failed
+        stats.total_time += request_time
+        stats.max_time = max(stats.max_time, request_time)
+
+
+def stats():
+    # type: () -> Dict[str, Dict[str, Any]]
+    """Get request counts and times of every endpoint requested so far, keyed by "api METHOD path"."""
+    with _stats_lock:
+        return {' '.join(endpoint): endpoint_stats.as_dict()
+                for endpoint, endpoint_stats in _stats.viewitems()}
+
+
+def endpoint_path(url):
+    # type: (str) -> str
+    """Get the path of `url`, which identifies its endpoint."""
+    return urlparse(url).path
+
+
+def _retry_after(response):
+    # type: (requests.Response) -> float
+    """Get the seconds to wait from a Retry-After header, or None."""
+    try:
+        return float(response.headers['Retry-After'])
+    except (KeyError, ValueError):
+        return None
+
+
+def request(api, method, url, **kwargs):
+    # type: (Api, str, str, **Any) -> requests.Response
+    """
+    Make a request to `api` through the shared session and return the response,
+    retrying connection errors, timeouts and `RETRY_STATUSES` up to `api.max_retries` times.
+    Each attempt waits for `api.rate_limit` at the current thread's priority (see `rate_limit`).
+
+    Raise a `requests.RequestException` if it still fails, including for error statuses.
+    """
+    kwargs.setdefault('timeout', (api.connect_timeout, api.read_timeout))
+    endpoint = (api.name, method.upper(), endpoint_path(url))
+    retry = 0
+    while True:
+        if api.rate_limit is not None:
+            _record_throttled(endpoint, api.rate_limit.acquire(rate_limit.current_priority()))
+        start = time.time()
+        wait = None  # type: float
+        try:
+            response = session.request(method, url, **kwargs)
+        except (requests.ConnectionError, requests.Timeout):
+            if retry >= api.max_retries:
+                _record(endpoint, time.time() - start, retry > 0, True)
+                raise
+        else:
+            if response.status_code not in RETRY_STATUSES or retry >= api.max_retries:
+                failed = not response.ok
+                _record(endpoint, time.time() - start, retry > 0, failed)
+                if failed:
+                    response.raise_for_status()
+                return response
+            wait = _retry_after(response)
+            response.close()
+        _record(endpoint, time.time() - start, retry > 0, True)
+        if wait is None:
+            wait = api.backoff_time(retry)
+        time.sleep(min(wait, api.max_backoff))
+        retry += 1
+
+
+def get(api, url, **kwargs):
+    # type: (Api, str, **Any) -> requests.Response
+    return request(api, 'GET', url, **kwargs)
+
+
+def post(api, url, **kwargs):
+    # type: (Api, str, **Any) -> requests.Response
+    return request(api, 'POST', url, **kwargs)
@@ -1,43 +1,63 @@
-import requests
-from typing import Tuple
+from typing import List, Tuple
 
+from api import http
+from api.response_cache import response_cache
 from api.secrets import musix
 from util.types import Json
 
 
-def get_song(song_num, country='us', key=musix.api_key):
-    # type: (int, str, str) -> Tuple[int, unicode, unicode, unicode]
-    """Return the id, artist, song_name, lyrics of the top `song_num`th song."""
+MAX_PAGE_SIZE = 100  # type: int
+
+
+def _get_json(url, params, max_stale=None):
+    # type: (str, Json, int) -> Json
+    """GET a Musixmatch response, cached unless it's an error."""
+    return response_cache.get_json(
+            http.MUSIXMATCH, url, params,
+            is_valid=lambda response: response['message']['header']['status_code'] == 200,
+            max_stale=max_stale)
+
+
+def get_chart(page, page_size=MAX_PAGE_SIZE, country='us', key=None, max_stale=None):
+    # type: (int, int, str, str, int) -> List[Tuple[int, unicode, unicode]]
+    """
+    Return the id, artist, song_name of each song on the `page`th page of the top songs,
+    from a cached chart at most `max_stale` seconds past its TTL if given.
+    """
+    if key is None:
+        key = musix.api_key
     
     # Filtering songs that are not instrumental, have lyrics,
     # from specified country, are not explicit
     payload = {
         'apikey': key,
-        'page': song_num,
-        'page_size': 1,
+        'page': page,
+        'page_size': page_size,
         'country': country,
         'f_has_lyrics': '1',
         'f_is_instrumental': '0',
         'f_is_explicit': '0',
     }
     
-    response = requests.get('https://api.musixmatch.com/ws/1.1/chart.tracks.get', params=payload) \
-        .json()  # type: Json
+    response = _get_json('https://api.musixmatch.com/ws/1.1/chart.tracks.get',
+                         payload, max_stale)  # type: Json
     
-    data = response['message']['body']['track_list'][0]['track']  # type: Json
-    id = data['track_id']
-    return id, data['artist_name'], data['track_name'], get_lyrics(id, key)
+    track_list = response['message']['body']['track_list']  # type: List[Json]
+    return [(track['track']['track_id'], track['track']['artist_name'], track['track']['track_name'])
+            for track in track_list]
 
 
-def get_lyrics(id, key=musix.api_key):
+def get_lyrics(id, key=None):
     # type: (int, str) -> unicode
-    """Get lyrics of a song based on track id (found using `get_song`)."""
+    """Get lyrics of a song based on track id (found using `get_chart`)."""
+    if key is None:
+        key = musix.api_key
     payload = {
         'apikey': key,
         'format': 'json',
         'track_id': id,
     }
-    lyrics = requests.get('https://api.musixmatch.com/ws/1.1/track.lyrics.get', params=payload) \
-        .json()['message']['body']['lyrics']['lyrics_body']  # type: unicode
+    lyrics = _get_json('https://api.musixmatch.com/ws/1.1/track.lyrics.get',
+                       payload)['message']['body']['lyrics']['lyrics_body']  # type: unicode
     end = lyrics.rfind('*' * 7, 0, lyrics.rfind('*' * 7))
     return lyrics[:end]
@@ -0,0 +1,192 @@
+"""
+Rate limiting of outbound API requests, with foreground requests (made while a user waits)
+going ahead of background ones (like prefetching).
+
+The priority is per thread, see `background_priority()`,
+and can be raised by other threads waiting on the thread's requests, see `raisable_priority()`.
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+
+from typing import Callable, ContextManager, Iterator, List
+
+from util import concurrency
+
+FOREGROUND = 0  # type: int
+BACKGROUND = 1  # type: int
+
+
+class Priority(object):
+    """
+    Mutable priority of a thread's requests.
+
+    :ivar value: FOREGROUND or BACKGROUND
+    :type value: int
+    """
+
+    def __init__(self, value):
+        # type: (int) -> None
+        self.value = value
+        # buckets requests at this priority are waiting in, once per waiting request
+        self._buckets = []  # type: List[TokenBucket]
+        self._lock = threading.Lock()
+
+    def raise_to(self, value):
+        # type: (int) -> None
+        """Raise this priority to `value` if that's higher, waking the requests waiting at it."""
+        with self._lock:
+            if value >= self.value:
+                return
+            self.value = value
+            buckets = set(self._buckets)
+        for bucket in buckets:
+            bucket.wake()
+
+
+_priority = threading.local()
+
+
+def current_priority():
+    # type: () -> Priority
+    """Get the `Priority` of the current thread's requests, a new FOREGROUND one by default."""
+    current = getattr(_priority, 'current', None)  # type: Priority
+    return Priority(FOREGROUND) if current is None else current
+
+
+def priority():
+    # type: () -> int
+    """Get the priority of the current thread's requests, FOREGROUND by default."""
+    return current_priority().value
+
+
+@contextmanager
+def _using_priority(current):
+    # type: (Priority) -> Iterator[Priority]
+    old_priority = getattr(_priority, 'current', None)  # type: Priority
+    _priority.current = current
+    try:
+        yield current
+    finally:
+        _priority.current = old_priority
+
+
+def _priority_context(value):
+    # type: (int) -> ContextManager[Priority]
+    return _using_priority(Priority(value))
+
+
+def _capture_priority():
+    # type: () -> Callable[[], ContextManager[Priority]]
+    current = getattr(_priority, 'current', None)  # type: Priority
+    return lambda: _using_priority(current)
+
+
+# e.g. chunks synthesized in parallel for a background job are requested at BACKGROUND priority
+concurrency.inherit_thread_state(_capture_priority)
+
+
+def background_priority():
+    # type: () -> ContextManager[Priority]
+    """Make requests of the current thread BACKGROUND priority within the context."""
+    return _priority_context(BACKGROUND)
+
+
+def raisable_priority():
+    # type: () -> ContextManager[Priority]
+    """
+    Keep the current thread's priority within the context,
+    but allow other threads to raise it with `join_priority()` of the yielded `Priority`.
+    """
+    return _priority_context(priority())
+
+
+def join_priority(leader_priority):
+    # type: (Priority) -> None
+    """Raise `leader_priority` to the current thread's, as it's waiting on the leader's requests."""
+    leader_priority.raise_to(priority())
+
+
+class TokenBucket(object):
+    """
+    Thread-safe token bucket allowing `rate` requests per second in bursts of up to `burst`.
+
+    BACKGROUND requests wait while any FOREGROUND request is waiting
+    and leave `foreground_reserve` tokens in the bucket for FOREGROUND requests.
+
+    :ivar rate: tokens added per second
+    :type rate: float
+
+    :ivar burst: max tokens in the bucket
+    :type burst: float
+
+    :ivar foreground_reserve: tokens only FOREGROUND requests may take
+    :type foreground_reserve: float
+    """
+
+    def __init__(self, rate, burst=1.0, foreground_reserve=0.0):
+        # type: (float, float, float) -> None
+        self.rate = rate
+        self.burst = burst
+        self.foreground_reserve = min(foreground_reserve, burst - 1)
+        self._tokens = float(burst)
+        self._last_refill = time.time()
+        # priority of each waiting request, re-read on every wakeup since it may be raised
+        self._waiting = []  # type: List[Priority]
+        self._condition = threading.Condition()
+
+    def share(self, num_sharers):
+        # type: (int) -> None
+        """Lower the rate, burst and reserve to this bucket's share when split `num_sharers` ways."""
+        with self._condition:
+            self.rate /= num_sharers
+            self.burst = max(1.0, self.burst / num_sharers)
+            self.foreground_reserve = min(self.foreground_reserve / num_sharers, self.burst - 1)
+            self._tokens = min(self._tokens, self.burst)
+
+    def _refill(self):
+        # type: () -> None
+        now = time.time()
+        self._tokens = min(self.burst, self._tokens + (now - self._last_refill) * self.rate)
+        self._last_refill = now
+
+    def wake(self):
+        # type: () -> None
+        """Wake waiting requests, e.g. because one's priority was raised."""
+        with self._condition:
+            self._condition.notify_all()
+
+    def acquire(self, priority=None):
+        # type: (Priority) -> float
+        """
+        Wait until a request of `priority` (the current thread's by default) may be made
+        and return the seconds waited.
+        """
+        if priority is None:
+            priority = current_priority()
+        start = time.time()
+        with self._condition:
+            self._waiting.append(priority)
+            with priority._lock:
+                priority._buckets.append(self)
+            try:
+                while True:
+                    self._refill()
+                    if priority.value == FOREGROUND:
+                        needed = 1.0
+                    elif any(waiting.value == FOREGROUND for waiting in self._waiting):
+                        needed = None
+                    else:
+                        needed = 1.0 + self.foreground_reserve
+                    if needed is not None and self._tokens >= needed:
+                        self._tokens -= 1
+                        return time.time() - start
+                    # woken early when a foreground request is done waiting or a priority is raised
+                    self._condition.wait(None if needed is None
+                                         else (needed - self._tokens) / self.rate)
+            finally:
+                self._waiting.remove(priority)
+                with priority._lock:
+                    priority._buckets.remove(self)
+                self._condition.notify_all()
@@ -0,0 +1,214 @@
+import os
+import sqlite3
+import threading
+import time
+
+import simplejson as json
+from typing import Any, Callable, Dict, Tuple, Union
+
+from api import http, rate_limit
+from util import io
+from util.jobs import JobExecutor
+from util.lazy import ProcessLocal
+from util.types import Json
+
+# params that don't affect the response
+IGNORED_PARAMS = frozenset(['apikey'])
+
+# seconds a response of each cached endpoint is fresh for, None for forever
+# endpoints not in here, like the random questions of api.php, aren't cached
+TTLS = {
+    '/ws/1.1/track.lyrics.get': None,  # lyrics never change
+    '/ws/1.1/chart.tracks.get': 10 * 60,
+    '/api_count.php': 24 * 60 * 60,
+}  # type: Dict[str, Union[int, None]]
+
+# seconds past its TTL a stale response is still served while it's revalidated in the background
+STALE_TTL = 24 * 60 * 60  # type: int
+
+# min seconds between writing the hit times recorded in memory, see `ResponseCache._record_hit()`
+HIT_WRITE_INTERVAL = 5 * 60  # type: int
+
+
+class ResponseCache(object):
+    """
+    Persistent SQLite cache of JSON responses of external APIs.
+
+    Responses are keyed by their endpoint and params (excluding `IGNORED_PARAMS`)
+    and expire after their endpoint's TTL in `ttls`.
+    Stale responses are still served for another `stale_ttl` seconds
+    while they're revalidated in the background.
+    When the responses exceed `max_size` bytes, the least-recently-hit ones are evicted.
+    Hits are recorded in memory and written in batches, so that lookups never write.
+
+    :ivar path: path of the SQLite DB
+    :type path: str
+
+    :ivar max_size: max total bytes of the responses
+    :type max_size: int
+
+    :ivar ttls: TTLs by endpoint path, see `TTLS`
+    :type ttls: Dict[str, Union[int, None]]
+
+    :ivar stale_ttl: seconds past its TTL a stale response may be served
+    :type stale_ttl: int
+    """
+
+    SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS responses(
+        key TEXT PRIMARY KEY,
+        body TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        fetched REAL NOT NULL,
+        last_hit REAL NOT NULL
+    )'''
+
+    def __init__(self, path='data/response_cache.db', max_size=64 << 20, ttls=None,
+                 stale_ttl=STALE_TTL):
+        # type: (str, int, Dict[str, Union[int, None]], int) -> None
+        self.path = path
+        self.max_size = max_size
+        self.ttls = TTLS if ttls is None else ttls
+        self.stale_ttl = stale_ttl
+        self._revalidator = ProcessLocal(
+                lambda: JobExecutor(num_workers=1, name='revalidate'))  # type: JobExecutor
+        self._schema_lock = threading.Lock()
+        self._has_schema = False
+        # last hit times not written yet, by key
+        self._hits = {}  # type: Dict[str, float]
+        self._hits_written = time.time()
+        self._hits_lock = threading.Lock()
+
+    @staticmethod
+    def key(url, params):
+        # type: (str, Dict[str, Any]) -> str
+        """Normalize `url` and `params` into a key."""
+        return json.dumps([url, sorted((name, unicode(value)) for name, value in params.viewitems()
+                                       if name not in IGNORED_PARAMS)])
+
+    def _connect(self):
+        # type: () -> sqlite3.Connection
+        with self._schema_lock:
+            if self._has_schema:
+                return sqlite3.connect(self.path, timeout=5.0)
+            io.mkdir_if_not_exists(os.path.dirname(self.path) or '.')
+            conn = sqlite3.connect(self.path, timeout=5.0)
+            conn.execute(ResponseCache.SCHEMA)
+            self._has_schema = True
+            return conn
+
+    def _lookup(self, key):
+        # type: (str) -> Union[Tuple[unicode, float], None]
+        conn = self._connect()
+        try:
+            result = conn.execute('SELECT body, fetched FROM responses WHERE key = ?',
+                                  [key]).fetchone()
+        finally:
+            conn.close()
+        if result is not None:
+            self._record_hit(key)
+        return result
+
+    def _record_hit(self, key):
+        # type: (str) -> None
+        """Record a hit of `key` in memory, writing the hits in the background now and then."""
+        now = time.time()
+        with self._hits_lock:
+            self._hits[key] = now
+            if now - self._hits_written < HIT_WRITE_INTERVAL:
+                return
+            self._hits_written = now
+        self._revalidator.submit('write_hits', self._write_hits)
+
+    def _update_hits(self, conn):
+        # type: (sqlite3.Connection) -> None
+        """Write the hit times recorded in memory in `conn`'s transaction."""
+        with self._hits_lock:
+            hits = self._hits
+            self._hits = {}
+        conn.executemany('UPDATE responses SET last_hit = MAX(last_hit, ?) WHERE key = ?',
+                         [(hit_time, key) for key, hit_time in hits.viewitems()])
+
+    def _write_hits(self):
+        # type: () -> None
+        conn = self._connect()
+        try:
+            with conn:
+                self._update_hits(conn)
+        finally:
+            conn.close()
+
+    def _store(self, key, body):
+        # type: (str, unicode) -> None
+        now = time.time()
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)',
+                             [key, body, len(body), now, now])
+                # so that eviction goes by up to date hit times
+                self._update_hits(conn)
+                self._evict(conn)
+        finally:
+            conn.close()
+
+    def _evict(self, conn):
+        # type: (sqlite3.Connection) -> None
+        """Evict the least-recently-hit responses until within `max_size`."""
+        size, = conn.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()
+        if size <= self.max_size:
+            return
+        evicted = []
+        for key, response_size in conn.execute(
+                'SELECT key, size FROM responses ORDER BY last_hit'):
+            if size <= self.max_size:
+                break
+            evicted.append((key,))
+            size -= response_size
+        conn.executemany('DELETE FROM responses WHERE key = ?', evicted)
+
+    def _fetch(self, api, url, params, key, is_valid):
+        # type: (http.Api, str, Dict[str, Any], str, Callable[[Json], bool]) -> Json
+        body = http.get(api, url, params=params).text  # type: unicode
+        response = json.loads(body)  # type: Json
+        if is_valid(response):
+            self._store(key, body)
+        return response
+
+    def _revalidate(self, api, url, params, key, is_valid):
+        # type: (http.Api, str, Dict[str, Any], str, Callable[[Json], bool]) -> None
+        with rate_limit.background_priority():
+            self._fetch(api, url, params, key, is_valid)
+
+    def get_json(self, api, url, params, is_valid=lambda response: True, wait=True,
+                 max_stale=None):
+        # type: (http.Api, str, Dict[str, Any], Callable[[Json], bool], bool, int) -> Union[Json, None]
+        """
+        GET the JSON response of `url` with `params` from `api`, from the cache if possible.
+
+        Only responses passing `is_valid` are cached,
+        e.g. so that errors reported in the body aren't cached.
+        Unless `wait`, a response that isn't cached (or is too stale to serve)
+        is fetched in the background instead, and None is returned.
+        Stale responses are served for at most `max_stale` seconds past their TTL
+        (at most `stale_ttl`, the default).
+        """
+        endpoint = http.endpoint_path(url)
+        if endpoint not in self.ttls:
+            return http.get(api, url, params=params).json()
+        ttl = self.ttls[endpoint]
+        stale_ttl = self.stale_ttl if max_stale is None else min(max_stale, self.stale_ttl)
+        key = ResponseCache.key(url, params)
+        cached = self._lookup(key)
+        age = None if cached is None else time.time() - cached[1]
+        if cached is None or ttl is not None and age > ttl + stale_ttl:
+            if wait:
+                return self._fetch(api, url, params, key, is_valid)
+            self._revalidator.submit(key, lambda: self._revalidate(api, url, params, key, is_valid))
+            return None
+        if ttl is not None and age > ttl:
+            self._revalidator.submit(key, lambda: self._revalidate(api, url, params, key, is_valid))
+        return json.loads(cached[0])
+
+
+response_cache = ResponseCache()
@@ -4,6 +4,7 @@ import simplejson as json
 from typing import Tuple
 
 from util.annotations import override
+from util.lazy import Lazy
 from util.tupleable import Tupleable
 from util.types import Json
 
@@ -62,4 +63,6 @@ def load_secrets(path='api/secrets.json'):
     )
 
 
-watson, musix = load_secrets()
\ No newline at end of file
+# loaded on first use, so importing the APIs doesn't need secrets.json
+watson = Lazy(lambda: load_secrets()[0])  # type: Watson
+musix = Lazy(lambda: load_secrets()[1])  # type: Musix
\ No newline at end of file
@@ -1,19 +1,133 @@
-from watson_developer_cloud import TextToSpeechV1 as TextToSpeech
+import re
+import struct
 
+from typing import List
+
+from api import audio_formats, http
+from api.audio_cache import AudioCache
 from api.secrets import watson
+from util.concurrency import parallel_map
+
+WATSON_URL = 'https://stream.watsonplatform.net/text-to-speech/api'  # type: str
+
+AUDIO_CACHE_SIZE = 1 << 30  # type: int
+
+audio_cache = AudioCache(max_size=AUDIO_CACHE_SIZE)
+
+CHUNK_PARALLELISM = 4  # type: int
+
+# encodings whose audio can be stitched together from separately synthesized chunks
+# (MP3 frames and chained Ogg streams can simply be concatenated)
+STITCHABLE_ENCODINGS = {'wav', 'mp3', 'ogg'}
 
-text_to_speech = TextToSpeech(username=watson.username, password=watson.password)
+_sentence_boundary = re.compile(r'(?<=[.!?])\s+|\n+')
 
 
-def download_audio(text, path, encoding='wav', voice='en-US_AllisonVoice'):
-    # type: (unicode, str) -> None
-    """Download `text` to filename `path`."""
-    with open(path, 'wb') as f:
-        f.write(text_to_speech.synthesize(text, accept='audio/' + encoding, voice=voice))
+def split_text(text, chunk_size):
+    # type: (unicode, int) -> List[unicode]
+    """
+    Split `text` into chunks of at most `chunk_size` characters,
+    at sentence or line boundaries if possible, otherwise at word boundaries.
+    """
+    chunks = []  # type: List[unicode]
+    chunk = u''
+    for piece in _sentence_boundary.split(text):
+        piece = piece.strip()
+        if len(piece) > chunk_size and chunk:
+            chunks.append(chunk)
+            chunk = u''
+        while len(piece) > chunk_size:
+            # sentence too long, so split at the last word boundary that fits
+            end = piece.rfind(u' ', 0, chunk_size + 1)
+            if end <= 0:
+                end = chunk_size
+            chunks.append(piece[:end].strip())
+            piece = piece[end:].strip()
+        if not piece:
+            continue
+        if chunk and len(chunk) + 1 + len(piece) > chunk_size:
+            chunks.append(chunk)
+            chunk = piece
+        else:
+            chunk = chunk + u' ' + piece if chunk else piece
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+def _split_wav(audio):
+    # type: (str) -> (str, str)
+    """Split wav `audio` into its header (through the data chunk header) and its sample data."""
+    data_start = audio.index('data', 12) + 8
+    return audio[:data_start], audio[data_start:]
+
+
+def stitch_audio(chunks, encoding):
+    # type: (List[str], str) -> str
+    """Stitch audio `chunks` encoded as `encoding` into one audio file."""
+    if encoding != 'wav':
+        return ''.join(chunks)
+    header = _split_wav(chunks[0])[0]
+    samples = ''.join(_split_wav(chunk)[1] for chunk in chunks)
+    # fix the RIFF and data chunk sizes for the stitched samples
+    return header[:4] + struct.pack('<I', len(header) - 8 + len(samples)) \
+           + header[8:-4] + struct.pack('<I', len(samples)) + samples
+
+
+def synthesize(text, encoding='wav', voice='en-US_AllisonVoice', chunk_size=None,
+               parallelism=CHUNK_PARALLELISM):
+    # type: (unicode, str, str, int, int) -> str
+    """
+    Synthesize `text`, encoded as one of `audio_formats.accept_types`.
+    
+    If `chunk_size` is given, long text is split into chunks (see `split_text()`),
+    which are synthesized on `parallelism` threads and stitched back together,
+    so the time taken is bounded by the slowest chunk rather than the whole text.
+    """
+    accept = audio_formats.accept_types[encoding]
+    
+    def synthesize_chunk(chunk):
+        # type: (unicode) -> str
+        return http.post(http.WATSON, WATSON_URL + '/v1/synthesize',
+                         auth=(watson.username, watson.password),
+                         params={'voice': voice},
+                         headers={'Accept': accept},
+                         json={'text': chunk}).content
+    
+    if chunk_size is None or len(text) <= chunk_size or encoding not in STITCHABLE_ENCODINGS:
+        return synthesize_chunk(text)
+    chunks = parallel_map(synthesize_chunk, split_text(text, chunk_size), parallelism)
+    return stitch_audio(chunks, encoding)
+
+
+def download_audio(text, path, encoding='wav', voice='en-US_AllisonVoice', chunk_size=None):
+    # type: (unicode, str, str, str, int) -> None
+    """
+    Download `text` to filename `path`, encoded as one of `audio_formats.accept_types`.
+    Audio already synthesized for the same text, voice and encoding is linked from `audio_cache`.
+    Long text is synthesized in chunks of `chunk_size` (see `synthesize()`).
+    """
+    key = AudioCache.key(text, voice, encoding)
+    cached_path = audio_cache.get(key, encoding)
+    if cached_path is None:
+        audio = synthesize(text, encoding, voice, chunk_size)
+        cached_path = audio_cache.put(key, encoding, audio)
+    AudioCache.link(cached_path, path)
 
 
 class AudioDownloader(object):
-    """Abstract mixin with download_audio() method using filename() and text() abstract methods."""
+    """
+    Abstract mixin with download_audio() method using filename() and text() abstract methods.
+    
+    :cvar AUDIO_ENCODING: default audio encoding, one of `audio_formats.accept_types`
+    :type AUDIO_ENCODING: str
+    
+    :cvar SYNTHESIS_CHUNK_SIZE: max characters synthesized per request, None for no chunking
+    :type SYNTHESIS_CHUNK_SIZE: int
+    """
+    
+    AUDIO_ENCODING = 'wav'  # type: str
+    SYNTHESIS_CHUNK_SIZE = None  # type: int
 
     def __init__(self, audio_path):
         # type: (str) -> None
@@ -29,10 +143,17 @@ class AudioDownloader(object):
         """Convert entire object to text Watson will read."""
         pass
     
-    def download_audio(self, dir_path, encoding='wav'):
-        # type: (str) -> None
-        """Download audio in `dir_path`."""
+    def audio_mime_type(self):
+        # type: () -> str
+        """Get the browser MIME type of the audio file."""
+        return audio_formats.mime_type(self.audio_path)
+    
+    def download_audio(self, dir_path, encoding=None):
+        # type: (str, str) -> None
+        """Download audio in `dir_path`, encoded as `encoding` or `AUDIO_ENCODING` by default."""
+        if encoding is None:
+            encoding = self.AUDIO_ENCODING
         filename = self.filename()
         path = dir_path + '/' + filename + '.' + encoding
-        download_audio(self.text(), path, encoding=encoding)
+        download_audio(self.text(), path, encoding=encoding, chunk_size=self.SYNTHESIS_CHUNK_SIZE)
         self.audio_path = path
\ No newline at end of file
@@ -1,21 +1,118 @@
+import threading
 from HTMLParser import HTMLParser
 
-import requests
-from typing import Iterable, List
+from typing import Iterable, List, Union
 
+from api import http
+from api.response_cache import response_cache
 from core.question_options import QuestionOptions
 from util.types import Json
 
 html_parser = HTMLParser()
 
+# Open Trivia response codes
+SUCCESS = 0
+NO_RESULTS = 1
+INVALID_PARAMETER = 2
+TOKEN_NOT_FOUND = 3
+TOKEN_EMPTY = 4
+RATE_LIMIT = 5
+
+
+class TriviaException(Exception):
+    pass
+
+
+class NotEnoughQuestionsException(TriviaException):
+    """There aren't as many questions as requested left for the options (and session token)."""
+    pass
+
+
+class SessionToken(object):
+    """
+    Open Trivia session token, which makes the API never return the same question twice.
+    Tokens expire after 6 hours of inactivity and are then requested again.
+    """
+
+    def __init__(self):
+        # type: () -> None
+        self._token = None  # type: str
+        self._lock = threading.Lock()
+
+    def get(self):
+        # type: () -> str
+        with self._lock:
+            if self._token is None:
+                response = http.get(http.TRIVIA, 'https://opentdb.com/api_token.php',
+                                    params={'command': 'request'}).json()  # type: Json
+                if response['response_code'] != SUCCESS:
+                    raise TriviaException('couldn\'t get a session token: {}'.format(response))
+                self._token = response['token']
+            return self._token
+
+    def invalidate(self, token):
+        # type: (str) -> None
+        """Request a new token next time, unless `token` was already replaced."""
+        with self._lock:
+            if self._token == token:
+                self._token = None
+
+
+session_token = SessionToken()
+
 
 def get_questions(num_questions, options):
     # type: (int, QuestionOptions) -> Iterable[Json]
+    """
+    Get `num_questions` questions with `options` not returned before with the session token.
+
+    Raise a `NotEnoughQuestionsException` if there aren't that many left.
+    """
     url = 'https://opentdb.com/api.php?amount={}&{}'.format(num_questions, options.urlencode())
-    results = requests.get(url).json()['results']  # type: List[Json]
+    for attempt in xrange(http.TRIVIA.max_retries + 1):
+        token = session_token.get()
+        response = http.get(http.TRIVIA, url, params={'token': token}).json()  # type: Json
+        response_code = response['response_code']  # type: int
+        if response_code == SUCCESS:
+            break
+        elif response_code in (NO_RESULTS, TOKEN_EMPTY):
+            raise NotEnoughQuestionsException(
+                    'not {} questions left for {}'.format(num_questions, options.urlencode()))
+        elif response_code == TOKEN_NOT_FOUND:
+            session_token.invalidate(token)
+        elif response_code != RATE_LIMIT:
+            raise TriviaException('Open Trivia response code {}'.format(response_code))
+    else:
+        raise TriviaException('Open Trivia response code {}'.format(response_code))
+
+    results = response['results']  # type: List[Json]
     for result in results:
         result['question'] = html_parser.unescape(result['question'])
         result['correct_answer'] = html_parser.unescape(result['correct_answer'])
         result['incorrect_answers'] = \
             [html_parser.unescape(answer) for answer in result['incorrect_answers']]
     return results
+
+
+def question_count(options):
+    # type: (QuestionOptions) -> Union[int, None]
+    """
+    Get the number of questions Open Trivia has for `options`, ignoring the type,
+    so it's an upper bound if the type isn't None.
+
+    Return None if it's unknown: without a category, since the global count is too large
+    to bound anything, or if the category's counts aren't cached yet.
+    They're then fetched in the background, so users never wait for them.
+    """
+    type, difficulty, category = options.api_values()
+    if category is None:
+        return None
+    response = response_cache.get_json(
+            http.TRIVIA, 'https://opentdb.com/api_count.php', {'category': category},
+            wait=False)  # type: Json
+    if response is None:
+        return None
+    counts = response['category_question_count']  # type: Json
+    if difficulty is None:
+        return counts['total_question_count']
+    return counts['total_{}_question_count'.format(difficulty)]
@@ -1,78 +1,166 @@
 from __future__ import print_function
 
 import os
+import random
+from functools import wraps
 from sys import stderr
 
-from flask import Flask, Response, flash, render_template, request, session
-from typing import Callable, Dict
+from flask import Flask, Response, abort, flash, g, jsonify, redirect, render_template, \
+    request, safe_join, session, url_for
+from intbitset import intbitset
+from typing import Any, Callable, Dict, List, Tuple, Union
 from werkzeug.datastructures import ImmutableMultiDict
 
-from core import background, question_options
+from api import audio_formats, http
+from core import question_options
+from core.config import Config, load_secret_key
 from core.listen_up_db import ListenUpDatabase
+from core.question_index import QuestionIndex
 from core.question_options import InvalidQuestionOptionException
+from core.questions import Question
+from core.songs import Song
 from core.users import User
-from util.flask.flask_utils import form_contains, post_only, preconditions, reroute_to, \
-    session_contains
-from util.flask.flask_utils_types import Precondition, Router
+from util import lazy
+from util.flask.file_serving import FileDigests, send_immutable_file
+from util.flask.flask_utils import form_contains, post_only, preconditions, reroute_to
+from util.flask.flask_utils_types import Router
 from util.flask.template_context import add_template_context, context
+from util.lazy import ProcessLocal
+from util.session_store import MemorySessionStore, SessionStore, SqliteSessionStore
 
 app = Flask(__name__, template_folder='../templates', static_folder='../static')
 
-db = ListenUpDatabase()
+# indices loaded by preload() before forking workers
+_preloaded_indices = None  # type: Tuple[QuestionIndex, intbitset]
 
-private_sesssion = {}  # type: Dict[int, User]
+
+def _create_db():
+    # type: () -> ListenUpDatabase
+    question_index, song_ids = _preloaded_indices or (None, None)
+    return ListenUpDatabase(app.config['DB_PATH'], app.config['AUDIO_DIR'],
+                            audio_quota=app.config['AUDIO_QUOTA'],
+                            eager_audio=app.config['EAGER_AUDIO'],
+                            question_index=question_index, song_ids=song_ids,
+                            index_snapshot_path=app.config['INDEX_SNAPSHOT_PATH'])
+
+
+# created on first use in each process, after configure_app() has configured the app
+db = ProcessLocal(_create_db)  # type: ListenUpDatabase
 
 # Keys in session
 UID_KEY = 'uid'
 
 
+def _create_session_store():
+    # type: () -> SessionStore
+    if app.config['SESSION_STORE'] == 'sqlite':
+        return SqliteSessionStore(app.config['SESSION_STORE_PATH'],
+                                  User.serialize, User.deserialize)
+    return MemorySessionStore()
+
+
+_session_store = ProcessLocal(_create_session_store)  # type: SessionStore
+
+
+def get_session_store():
+    # type: () -> SessionStore
+    """
+    Get the store of logged in Users, according to the SESSION_STORE config:
+        sqlite (default): shared by all worker processes, in the SESSION_STORE_PATH SQLite DB
+        memory: in-process, only for a single worker process, see check_num_workers()
+    """
+    return _session_store
+
+
 def get_user():
-    # type: () -> User
-    """Get User in session."""
-    return private_sesssion[session[UID_KEY]]
+    # type: () -> Union[User, None]
+    """Get User in session, loaded from the session store once per request."""
+    if 'user' not in g:
+        g.user = None
+        if UID_KEY in session:
+            g.user = get_session_store().get(session[UID_KEY])
+            if g.user is None:
+                # expired from the session store
+                del session[UID_KEY]
+    return g.user
 
 
 def set_user(user):
     # type: (User) -> None
     """Set/put User in session."""
     session[UID_KEY] = user.id
-    private_sesssion[user.id] = user
+    g.user = user
+    get_session_store().put(user.id, user)
 
 
 def remove_user():
     # type: () -> None
     """Remove User from session"""
-    del private_sesssion[session[UID_KEY]]
-    del session[UID_KEY]
+    get_session_store().delete(session.pop(UID_KEY))
+    g.user = None
+
+
+@app.after_request
+def save_user(response):
+    # type: (Response) -> Response
+    """Write back the User in session, which the request may have changed."""
+    user = g.get('user')
+    if user is not None:
+        get_session_store().put(user.id, user)
+    return response
+
+
+def is_logged_in():
+    # type: () -> bool
+    """Check if a User is logged in."""
+    return get_user() is not None
 
 
-is_logged_in = session_contains(UID_KEY)  # type: Precondition
-is_logged_in.func_name = 'is_logged_in'
 context[is_logged_in.func_name] = is_logged_in
 
 
-@app.before_request
-def pause_background_threads():
-    # type: () -> ()
-    """
-    Acquire background lock to stop background threads from making any more HTTP requests
-    during the Flask request.
-    """
-    # signal.pthread_kill() doesn't exist in Python 2
-    # so can't stop and resume background threads (using SIGSTOP, SIGCONT)
-    # that may be in the middle of downloading something
-    # so the website might be very slow when downloading stuff
-    # because the flask route is being block
-    background.lock.acquire()
+audio_digests = FileDigests()
 
 
-@app.after_request
-def resume_background_threads(response):
-    # type: (Response) -> Response
-    """Release background lock to allow background threads to continue."""
-    # see comment in pause_background_threads()
-    background.lock.release()
-    return response
+def audio_url(audio_path):
+    # type: (str) -> str
+    """Get the content-hashed URL of `audio_path` served by audio()."""
+    return url_for('audio', digest=audio_digests.digest(audio_path),
+                   path=os.path.relpath(audio_path, db.audio_dir))
+
+
+context[audio_url.func_name] = audio_url
+
+
+@app.route('/audio/<digest>/<path:path>')
+def audio(digest, path):
+    # type: (str, str) -> Response
+    """
+    Serve an audio file with Range support and immutable cache headers.
+
+    The digest in the URL makes it unique per content, so it can be cached forever.
+    How the file is sent is set by the AUDIO_SEND_MODE config (see send_immutable_file()).
+    """
+    audio_path = safe_join(db.audio_dir, path)
+    if audio_path is None:
+        abort(404)
+    if not db.audio_store.touch(audio_path):
+        # evicted from the audio store, so synthesize it again
+        audio_digests.forget(audio_path)
+        restored_path = db.restore_audio(audio_path)
+        if restored_path is None:
+            abort(404)
+        if restored_path != audio_path:
+            return redirect(audio_url(restored_path))
+    current_digest = audio_digests.digest(audio_path)
+    if digest != current_digest:
+        # audio was re-synthesized, so the old URL is stale
+        return redirect(url_for('audio', digest=current_digest, path=path))
+    accel_prefix = app.config['AUDIO_ACCEL_PREFIX']
+    return send_immutable_file(audio_path, current_digest,
+                               mimetype=audio_formats.mime_type(audio_path),
+                               mode=app.config['AUDIO_SEND_MODE'],
+                               accel_path=accel_prefix + path)
 
 
 @app.reroute_from('/')
@@ -204,11 +292,14 @@ def choose_options():
 def set_options():
     # type: () -> Response
     """Set the user's question options from the form submitted in choose_options()."""
+    user = get_user()
     try:
-        get_user().set_options(request.form)
+        user.set_options(request.form)
     except InvalidQuestionOptionException as e:
         flash(e.message)
         return reroute_to(choose_options)
+    # start downloading questions for the new options before the user asks for one
+    db.prefetch_questions(user)
     return reroute_to(answer_question)
 
 
@@ -217,14 +308,186 @@ def set_options():
 def logout():
     # type: () -> Response
     """Log the user out."""
+    db.flush_user_stats(get_user())
     remove_user()
     return reroute_to(welcome)
 
 
-def run(debug=True):
-    # type: (bool) -> None
-    app.debug = True
-    app.secret_key = os.urandom(32)
+# JSON API, so clients can get questions in batches and answer without redirects
+
+MAX_QUESTIONS_PER_REQUEST = 10  # type: int
+
+
+def api_error(status, message):
+    # type: (int, unicode) -> Response
+    response = jsonify(error=message)  # type: Response
+    response.status_code = status
+    return response
+
+
+def api_logged_in(route_func):
+    # type: (Callable[..., Response]) -> Callable[..., Response]
+    """Decorate an API route to respond with a 401 error if no User is logged in."""
+
+    @wraps(route_func)
+    def checked(*args, **kwargs):
+        # type: () -> Response
+        if not is_logged_in():
+            return api_error(401, 'not logged in')
+        return route_func(*args, **kwargs)
+
+    return checked
+
+
+def num_questions_arg(num_questions):
+    # type: (int) -> int
+    """Clamp the requested number of questions to [1, MAX_QUESTIONS_PER_REQUEST]."""
+    return max(1, min(num_questions or 1, MAX_QUESTIONS_PER_REQUEST))
+
+
+def question_json(question):
+    # type: (Question) -> Dict[str, Any]
+    """Get the JSON of `question` for the user, without its answer."""
+    return dict(id=question.id,
+                question=question.question,
+                choices=question.choices,
+                type=question.type,
+                difficulty=question.difficulty,
+                category=question.category,
+                audio_url=audio_url(question.audio_path),
+                audio_mime_type=question.audio_mime_type(),
+                )
+
+
+def song_json(song):
+    # type: (Song) -> Dict[str, Any]
+    return dict(id=song.id,
+                artist=song.artist,
+                name=song.name,
+                lyrics=song.bleeped_lyrics(),
+                audio_url=audio_url(song.audio_path),
+                audio_mime_type=song.audio_mime_type(),
+                )
+
+
+def next_round_json(user, num_questions):
+    # type: (User, int) -> Dict[str, Any]
+    """
+    Get the JSON of the song `user` just won, like answer_question(),
+    or else of their next `num_questions` questions.
+    """
+    with db:
+        if user.has_won():
+            return dict(points=user.points, song=song_json(db.next_song(user, record=True)))
+        questions = db.next_questions(user, num_questions)  # type: List[Question]
+        return dict(points=user.points, questions=[question_json(q) for q in questions])
+
+
+@app.route('/api/questions')
+@api_logged_in
+def api_questions():
+    # type: () -> Response
+    """
+    Get the user's next ?n= questions (1 by default) with their audio URLs,
+    or the song they won instead.
+    """
+    num_questions = num_questions_arg(request.args.get('n', type=int))
+    try:
+        return jsonify(next_round_json(get_user(), num_questions))
+    except db.exception as e:
+        return api_error(404, e.message)
+
+
+@app.route('/api/answers', methods=['post'])
+@api_logged_in
+def api_answers():
+    # type: () -> Response
+    """
+    Check a batch of answers, {"answers": [{"question_id": ..., "answer": ...}, ...], "n": ...},
+    and respond with which were correct together with the next n questions (1 by default),
+    like check_answer() and then answer_question() in a single round-trip.
+    """
+    body = request.get_json(silent=True)
+    try:
+        answers = [(int(answer['question_id']), unicode(answer['answer']))
+                   for answer in body['answers']]  # type: List[Tuple[int, unicode]]
+        num_questions = num_questions_arg(int(body.get('n', 1)))
+    except (TypeError, KeyError, ValueError, AttributeError):
+        return api_error(400, 'expected {"answers": [{"question_id": ..., "answer": ...}, ...]}')
+    user = get_user()
+    try:
+        correct = db.answer_questions(user, answers)  # type: List[bool]
+        round_json = next_round_json(user, num_questions)
+    except db.exception as e:
+        return api_error(404, e.message)
+    round_json['results'] = [dict(question_id=question_id, correct=is_correct)
+                             for (question_id, answer), is_correct in zip(answers, correct)]
+    return jsonify(round_json)
+
+
+_configured = False
+
+
+def configure_app(config=None):
+    # type: (Dict[str, Any]) -> Flask
+    """
+    Configure and return the module's app, with `config` overriding the defaults in `Config`.
+
+    The DB and session store are bound to the config when first used,
+    so this may only be called once per process.
+
+    Nothing expensive is done here: the DB, API clients and background workers
+    are created lazily in each process when they're first used,
+    so the app can be configured before a preforking server forks its workers.
+    """
+    global _configured
+    if _configured:
+        raise RuntimeError('the app can only be configured once per process')
+    _configured = True
+    app.config.from_object(Config)
+    if config is not None:
+        app.config.update(config)
+    app.secret_key = load_secret_key(app.config['SECRET_KEY_PATH'])
     add_template_context(app)
     # use_named_tuple_json(app)
-    app.run()
+    return app
+
+
+def check_num_workers(num_workers):
+    # type: (int) -> None
+    """Check the config can be served by `num_workers` worker processes."""
+    if num_workers > 1 and app.config['SESSION_STORE'] == 'memory':
+        raise ValueError('the memory session store can\'t be shared by {} worker processes, '
+                         'use the sqlite one'.format(num_workers))
+
+
+def preload():
+    # type: () -> None
+    """
+    Load the read-only question index and song ids in the master process before forking workers,
+    so that they share them copy-on-write.
+    The DB used to load them is closed, so no connections or threads are inherited.
+    """
+    global _preloaded_indices
+    preload_db = _create_db()
+    try:
+        _preloaded_indices = preload_db.in_memory_indices()
+    finally:
+        preload_db.close()
+
+
+def post_fork(num_workers=1):
+    # type: (int) -> None
+    """Initialize one of `num_workers` worker processes right after it's forked."""
+    # otherwise every worker would make the same random choices
+    random.seed()
+    # the API quotas are shared by all the workers
+    http.share_rate_limits(num_workers)
+    # open the DB now rather than during the worker's first request
+    lazy.resolve(db)
+    db.prefetch_session_token()
+
+
+def run(debug=True):
+    # type: (bool) -> None
+    configure_app({'DEBUG': debug}).run()
@@ -0,0 +1,144 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from typing import Callable, Dict, List, Set
+
+from util import io
+
+
+class AudioStore(object):
+    """
+    Keeps the audio files under `root` within a byte quota,
+    evicting the least-recently-served files first.
+
+    Files in `pinned_paths()`, e.g. because they're about to be served, are never evicted.
+    Evicted files are expected to be re-synthesized on demand.
+
+    Last-served times are kept in the files' access times,
+    so the LRU order survives restarts (and doesn't depend on the filesystem's atime setting).
+
+    Files hardlinked from the `AudioCache` take no disk space of their own,
+    since evicting them frees nothing while the cache keeps its link,
+    so only files with a single link count towards the quota.
+    The files under `root` are scanned when first needed, and then every `RESCAN_INTERVAL` adds
+    to pick up files whose cache link was since evicted, and files written by other processes.
+
+    :ivar root: directory of the audio files
+    :type root: str
+
+    :ivar quota: max total bytes of audio files
+    :type quota: int
+    """
+
+    RESCAN_INTERVAL = 256  # type: int
+
+    def __init__(self, root, quota, pinned_paths=None):
+        # type: (str, int, Callable[[], Set[str]]) -> None
+        self.root = root
+        self.quota = quota
+        self._pinned_paths = pinned_paths or set  # type: Callable[[], Set[str]]
+        # path to bytes counted towards the quota, least-recently-used first
+        self._files = OrderedDict()  # type: Dict[str, int]
+        self._size = 0
+        # adds since the last scan, None if never scanned
+        self._num_adds = None  # type: int
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _own_size(stat):
+        # type: (os.stat_result) -> int
+        """Get the bytes only the file with `stat` takes, i.e. 0 if it's hardlinked elsewhere."""
+        return stat.st_size if stat.st_nlink == 1 else 0
+
+    def _scan(self):
+        # type: () -> None
+        """Reload all the files under `root`, ordered by access time."""
+        files = []
+        for dir_path, dir_names, filenames in os.walk(self.root):
+            for filename in filenames:
+                path = os.path.join(dir_path, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    # removed in the meantime
+                    continue
+                files.append((stat.st_atime, path, AudioStore._own_size(stat)))
+        files.sort()
+        with self._lock:
+            self._files = OrderedDict((path, size) for atime, path, size in files)
+            self._size = sum(self._files.itervalues())
+            self._num_adds = 0
+
+    def _scan_if_needed(self):
+        # type: () -> None
+        with self._lock:
+            num_adds = self._num_adds
+        if num_adds is None or num_adds >= AudioStore.RESCAN_INTERVAL:
+            self._scan()
+
+    @property
+    def size(self):
+        # type: () -> int
+        """Total bytes of audio files counted towards the quota."""
+        self._scan_if_needed()
+        return self._size
+
+    def add(self, path):
+        # type: (str) -> List[str]
+        """
+        Record the just written file at `path` as the most-recently-used
+        and evict files if over quota.  Return the evicted paths.
+        """
+        size = AudioStore._own_size(os.stat(path))
+        with self._lock:
+            self._size += size - self._files.pop(path, 0)
+            self._files[path] = size
+            if self._num_adds is not None:
+                self._num_adds += 1
+        return self.evict()
+
+    def touch(self, path):
+        # type: (str) -> bool
+        """Record that the file at `path` was served.  Return False if it doesn't exist."""
+        try:
+            os.utime(path, (time.time(), os.path.getmtime(path)))
+        except OSError:
+            self.discard(path)
+            return False
+        with self._lock:
+            size = self._files.pop(path, None)
+            if size is not None:
+                self._files[path] = size
+                return True
+        self.add(path)
+        return True
+
+    def discard(self, path):
+        # type: (str) -> None
+        """Forget the file at `path`, e.g. after it was removed by someone else."""
+        with self._lock:
+            self._size -= self._files.pop(path, 0)
+
+    def evict(self):
+        # type: () -> List[str]
+        """Remove least-recently-used, unpinned files until within quota.  Return their paths."""
+        self._scan_if_needed()
+        evicted = []  # type: List[str]
+        with self._lock:
+            if self._size <= self.quota:
+                return evicted
+        pinned = self._pinned_paths()  # type: Set[str]
+        with self._lock:
+            for path, size in self._files.items():
+                if self._size <= self.quota:
+                    break
+                if path in pinned or size == 0:
+                    # removing a file hardlinked from the cache frees nothing
+                    continue
+                io.remove_if_exists(path)
+                del self._files[path]
+                self._size -= size
+                evicted.append(path)
+        return evicted
@@ -0,0 +1,48 @@
+import os
+
+from core.listen_up_db import ListenUpDatabase
+
+
+def load_secret_key(path):
+    # type: (str) -> str
+    """
+    Get the secret key signing sessions from the LISTEN_UP_SECRET_KEY environment variable,
+    or else from the file at `path`, which is created with a random key the first time,
+    so that all worker processes (and restarts) share the same key.
+    """
+    secret_key = os.environ.get('LISTEN_UP_SECRET_KEY')
+    if secret_key:
+        return secret_key
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0600)
+    except OSError:
+        # already created, maybe just now by another worker
+        pass
+    else:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(os.urandom(32))
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+class Config(object):
+    """Default config of the app, see `core.app.configure_app()`."""
+
+    DEBUG = False
+
+    DB_PATH = 'data/listen_up.db'
+    # see core.index_snapshot
+    INDEX_SNAPSHOT_PATH = 'data/listen_up.index'
+    AUDIO_DIR = 'static/audio'
+    AUDIO_QUOTA = ListenUpDatabase.AUDIO_QUOTA
+    EAGER_AUDIO = False
+
+    # see util.flask.file_serving.send_immutable_file()
+    AUDIO_SEND_MODE = 'sendfile'
+    AUDIO_ACCEL_PREFIX = '/_audio/'
+
+    # sqlite or memory (only for a single worker process), see core.app.get_session_store()
+    SESSION_STORE = 'sqlite'
+    SESSION_STORE_PATH = 'data/sessions.db'
+
+    SECRET_KEY_PATH = 'data/secret_key'
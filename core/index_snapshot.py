@@ -0,0 +1,98 @@
+"""
+Versioned snapshot file of the in-memory question index and song ids,
+so that new processes load them instead of scanning the questions and songs tables.
+
+The file is a magic line, a JSON header line and then the `fastdump()`ed intbitsets,
+which are read through mmap.  Only the rows added to the DB since need to be replayed.
+"""
+
+import mmap
+import os
+import simplejson as json
+from intbitset import intbitset
+
+from typing import List, Tuple, Union
+
+from core.question_index import QuestionIndex
+from util import io
+
+MAGIC = 'listen-up-index-snapshot\n'  # type: str
+# incremented whenever the format or QuestionIndex keys change, invalidating old snapshots
+VERSION = 1  # type: int
+
+
+def watermark(ids):
+    # type: (intbitset) -> Tuple[int, int]
+    """
+    Get the (max id, number of ids) of `ids`.
+    A snapshot is up to date up to its max id iff the table has that many rows up to it.
+    """
+    return (ids[-1] if ids else 0), len(ids)
+
+
+def save(path, db_id, question_index, song_ids):
+    # type: (str, str, QuestionIndex, intbitset) -> None
+    """Atomically write a snapshot of `question_index` and `song_ids` of the DB `db_id` to `path`."""
+    blobs = []  # type: List[str]
+    keys = []  # type: List[list]
+    offset = 0
+    for key, ids in question_index.bitsets().viewitems():
+        blob = ids.fastdump()  # type: str
+        keys.append([list(key), offset, len(blob)])
+        blobs.append(blob)
+        offset += len(blob)
+    song_ids_blob = song_ids.fastdump()  # type: str
+    blobs.append(song_ids_blob)
+    header = dict(version=VERSION, db_id=db_id, keys=keys,
+                  song_ids=[offset, len(song_ids_blob)])
+
+    io.mkdir_if_not_exists(os.path.dirname(path) or '.')
+    # other processes may be writing their own snapshots at the same time
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(json.dumps(header) + '\n')
+        for blob in blobs:
+            f.write(blob)
+    os.rename(tmp_path, path)
+
+
+def _load_bitset(contents, start, offset, length):
+    # type: (mmap.mmap, int, int, int) -> intbitset
+    ids = intbitset()
+    ids.fastload(contents[start + offset:start + offset + length])
+    return ids
+
+
+def load(path, db_id):
+    # type: (str, str) -> Union[Tuple[QuestionIndex, intbitset], None]
+    """
+    Load the (question index, song ids) snapshotted at `path`,
+    or None if there isn't one of this version for the DB `db_id`.
+    """
+    try:
+        f = open(path, 'rb')
+    except IOError:
+        return None
+    with f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return None
+        contents = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        if contents[:len(MAGIC)] != MAGIC:
+            return None
+        header_end = contents.find('\n', len(MAGIC))
+        header = json.loads(contents[len(MAGIC):header_end])
+        if header['version'] != VERSION or header['db_id'] != db_id:
+            return None
+        start = header_end + 1
+        question_index = QuestionIndex.from_bitsets(
+                {tuple(key): _load_bitset(contents, start, offset, length)
+                 for key, offset, length in header['keys']})
+        song_ids = _load_bitset(contents, start, *header['song_ids'])
+        return question_index, song_ids
+    except (ValueError, KeyError):
+        # corrupted
+        return None
+    finally:
+        contents.close()
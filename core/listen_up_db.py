@@ -1,15 +1,31 @@
+import atexit
+import os
 import random
+import threading
+import time
+import uuid
+from collections import OrderedDict
 from intbitset import intbitset
+from requests import RequestException
 from sqlite3 import IntegrityError
 
-from typing import Iterable, List, Set, Tuple, Union
+from typing import Any, Callable, Dict, Hashable, Iterable, Iterator, List, Set, Tuple, Union
 
+from api import music, rate_limit, trivia
+from core import index_snapshot
+from core.audio_store import AudioStore
+from core.prefetcher import QuestionPrefetcher
+from core.question_index import QuestionIndex
+from core.question_options import QuestionOptions
 from core.questions import Question, get_questions
 from core.songs import Song
 from core.users import User
 from util import io
+from util.concurrency import parallel_map
 from util.db.db import ApplicationDatabase, ApplicationDatabaseException
+from util.db.write_behind import WriteBehindBuffer
 from util.password import hash_password, verify_password
+from util.single_flight import SingleFlight
 
 SCHEMA = dict(
         users='''
@@ -22,6 +38,12 @@ SCHEMA = dict(
             songs BINARY BLOB NOT NULL
         )''',
         
+        meta='''
+        CREATE TABLE IF NOT EXISTS meta(
+            key TEXT PRIMARY KEY,
+            value NOT NULL
+        )''',
+        
         questions='''
         CREATE TABLE IF NOT EXISTS questions(
             id INTEGER PRIMARY KEY,
@@ -31,9 +53,20 @@ SCHEMA = dict(
             type INTEGER NOT NULL,
             difficulty INTEGER NOT NULL,
             category TEXT NOT NULL,
-            audio_path TEXT NOT NULL
+            audio_path TEXT NOT NULL,
+            content_key TEXT
         )''',
         # questions will be a binary python buffer from the intbitset
+        # content_key is Question.content_key(), used to deduplicate questions
+        
+        chart='''
+        CREATE TABLE IF NOT EXISTS chart(
+            rank INTEGER PRIMARY KEY,
+            track_id INTEGER NOT NULL,
+            artist TEXT NOT NULL,
+            name TEXT NOT NULL
+        )''',
+        # chart is a local snapshot of the Musixmatch top songs, see ListenUpDatabase.new_song()
         
         songs='''
         CREATE TABLE IF NOT EXISTS songs(
@@ -46,6 +79,15 @@ SCHEMA = dict(
 )
 
 
+INDICES = [
+    'CREATE UNIQUE INDEX IF NOT EXISTS questions_content_key ON questions(content_key)',
+    'CREATE UNIQUE INDEX IF NOT EXISTS users_username ON users(username)',
+    # for restoring evicted audio files by path
+    'CREATE INDEX IF NOT EXISTS questions_audio_path ON questions(audio_path)',
+    'CREATE INDEX IF NOT EXISTS songs_audio_path ON songs(audio_path)',
+]
+
+
 class ListenUpDatabaseException(ApplicationDatabaseException):
     pass
 
@@ -61,33 +103,387 @@ class ListenUpDatabase(ApplicationDatabase):
     
     DEFAULT_BUF_SIZE = 5  # type: int
     
-    def __init__(self, path='data/listen_up.db', audio_dir='static/audio'):
-        # type: (str, str) -> None
-        super(ListenUpDatabase, self).__init__(SCHEMA, path, ListenUpDatabaseException)
+    STATS_FLUSH_INTERVAL = 2.0  # type: float
+    STATS_FLUSH_SIZE = 128  # type: int
+    
+    CHART_TTL = 6 * 60 * 60  # type: int
+    CHART_PAGE_SIZE = music.MAX_PAGE_SIZE  # type: int
+    
+    SYNTHESIS_PARALLELISM = 4  # type: int
+    QUESTION_ID_BLOCK_SIZE = 16  # type: int
+    # max trivia API requests made to download questions at once
+    MAX_DOWNLOAD_ROUNDS = 8  # type: int
+    # seconds to not download questions for options whose pool of questions was exhausted
+    EXHAUSTED_TTL = 60 * 60  # type: int
+    
+    AUDIO_QUOTA = 512 << 20  # type: int
+    
+    # audio_path of questions whose audio hasn't been synthesized yet
+    PENDING_AUDIO_PATH = ''  # type: str
+    AUDIO_LOOKAHEAD = 3  # type: int
+    
+    def __init__(self, path='data/listen_up.db', audio_dir='static/audio',
+                 stats_flush_interval=STATS_FLUSH_INTERVAL, stats_flush_size=STATS_FLUSH_SIZE,
+                 synthesis_parallelism=SYNTHESIS_PARALLELISM, audio_quota=AUDIO_QUOTA,
+                 eager_audio=False, audio_lookahead=AUDIO_LOOKAHEAD,
+                 question_index=None, song_ids=None, index_snapshot_path=None):
+        # type: (str, str, float, int, int, int, bool, int, QuestionIndex, intbitset, str) -> None
+        """
+        `question_index` and `song_ids` are normally loaded when first used,
+        from the snapshot at `index_snapshot_path` (next to the DB by default) or else from the DB,
+        but may be passed in from `in_memory_indices()` of a DB loaded before forking,
+        so that forked processes share them copy-on-write.
+        """
+        super(ListenUpDatabase, self).__init__(SCHEMA, path, ListenUpDatabaseException,
+                                               indices=INDICES)
         self.audio_dir = audio_dir  # type: str
         self.questions_dir = audio_dir + '/' + ListenUpDatabase.QUESTIONS_DIR
         self.songs_dir = audio_dir + '/' + ListenUpDatabase.SONGS_DIR
         for dir_name in ListenUpDatabase.DIRS:
             dir_path = audio_dir + '/' + dir_name
             io.mkdir_if_not_exists(dir_path)
-        self._questions = set(self._get_all_questions())  # type: Set[Question]
-        self._song_ids = self._get_all_song_ids()  # type: intbitset
-    
-    def _get_all_questions(self):
-        # type: () -> Iterable[Question]
-        """Get all questions in DB."""
-        for id, question, answer, choices, type, difficulty, category, audio_path \
-                in self.db.cursor.execute(
+        self.synthesis_parallelism = synthesis_parallelism  # type: int
+        # if not eager, question audio is synthesized when first served, see next_question()
+        self.eager_audio = eager_audio  # type: bool
+        self.audio_lookahead = audio_lookahead  # type: int
+        self.prefetcher = QuestionPrefetcher(self)  # type: QuestionPrefetcher
+        # coalesces identical concurrent downloads, e.g. when many users run out of questions
+        # foreground callers joining a background call raise its requests' priority to theirs
+        self._single_flight = SingleFlight(rate_limit.raisable_priority,
+                                           rate_limit.join_priority)  # type: SingleFlight
+        # when the trivia API ran out of questions for each options
+        self._exhausted_options = {}  # type: Dict[Tuple[str, str, str], float]
+        # audio of questions in prefetch buffers is never evicted
+        self.audio_store = AudioStore(audio_dir, audio_quota,
+                                      self._buffered_audio_paths)  # type: AudioStore
+        self._question_ids_lock = threading.Lock()
+        self._next_question_ids = iter(())  # type: Iterator[int]
+        # (question index, song ids), loaded on first use so that startup doesn't scan the DB
+        self._indices = None  # type: Tuple[QuestionIndex, intbitset]
+        if question_index is not None and song_ids is not None:
+            self._indices = question_index, song_ids
+        self._indices_lock = threading.Lock()
+        self.index_snapshot_path = index_snapshot_path \
+                                   or os.path.splitext(path)[0] + '.index'  # type: str
+        # watermarks of the indices when last loaded from or saved to the snapshot
+        self._snapshot_watermarks = None  # type: Tuple[Tuple[int, int], Tuple[int, int]]
+        # dirty user stats are written behind in batches instead of committing on every answer
+        self._user_stats = WriteBehindBuffer(self._write_user_stats,
+                                             stats_flush_interval, stats_flush_size,
+                                             name='user_stats_writer')  # type: WriteBehindBuffer
+        # stop the writer thread before the interpreter tears down, writing the last stats,
+        # and save the index snapshot, unless closed before
+        self._closed = False
+        atexit.register(self._finish_at_exit)
+    
+    def in_memory_indices(self):
+        # type: () -> Tuple[QuestionIndex, intbitset]
+        """Get the in-memory question index and song ids, loaded on first use, see `__init__()`."""
+        if self._indices is None:
+            with self._indices_lock:
+                if self._indices is None:
+                    self._indices = self._load_indices()
+        return self._indices
+    
+    @staticmethod
+    def _watermarks(indices):
+        # type: (Tuple[QuestionIndex, intbitset]) -> Tuple[Tuple[int, int], Tuple[int, int]]
+        question_index, song_ids = indices
+        return index_snapshot.watermark(question_index.ids()), index_snapshot.watermark(song_ids)
+    
+    def _rows_since_snapshot(self, table, columns, ids):
+        # type: (str, str, intbitset) -> Union[List[tuple], None]
+        """
+        Get the `columns` of the rows of `table` added since the snapshot of their `ids`,
+        or None if rows were since deleted or inserted out of id order, so it must be rebuilt.
+        """
+        max_id, num_ids = index_snapshot.watermark(ids)
+        self.db.cursor.execute('SELECT COUNT(*) FROM {} WHERE id <= ?'.format(table), [max_id])
+        if self.db.cursor.fetchone()[0] != num_ids:
+            return None
+        return self.db.cursor.execute(
+                'SELECT {} FROM {} WHERE id > ?'.format(columns, table), [max_id]).fetchall()
+    
+    def _load_indices(self):
+        # type: () -> Tuple[QuestionIndex, intbitset]
+        """
+        Load the question index and song ids from the snapshot, replaying rows added since,
+        or else from the DB, and then save them to the snapshot if they changed.
+        """
+        snapshot = index_snapshot.load(self.index_snapshot_path, self._get_db_id())
+        question_index, song_ids = snapshot or (None, None)
+        snapshot_watermarks = None if snapshot is None else self._watermarks(snapshot)
+        with self.reading():
+            new_questions = None if snapshot is None else self._rows_since_snapshot(
+                    'questions', 'id, type, difficulty, category', question_index.ids())
+            if new_questions is None:
+                question_index = QuestionIndex()
+                new_questions = self.db.cursor.execute(
+                        'SELECT id, type, difficulty, category FROM questions')
+            question_index.add_all(new_questions)
+            
+            new_songs = None if snapshot is None \
+                else self._rows_since_snapshot('songs', 'id', song_ids)
+            if new_songs is None:
+                song_ids = self._get_all_song_ids()
+            else:
+                song_ids.update([song_id for song_id, in new_songs])
+        
+        indices = question_index, song_ids
+        self._snapshot_watermarks = snapshot_watermarks
+        self._save_index_snapshot(indices)
+        return indices
+    
+    def _save_index_snapshot(self, indices):
+        # type: (Tuple[QuestionIndex, intbitset]) -> None
+        watermarks = self._watermarks(indices)
+        if watermarks == self._snapshot_watermarks:
+            return
+        index_snapshot.save(self.index_snapshot_path, self._get_db_id(), *indices)
+        self._snapshot_watermarks = watermarks
+    
+    def save_index_snapshot(self):
+        # type: () -> None
+        """Save the in-memory indices to the snapshot if they were loaded and changed since."""
+        if self._indices is not None:
+            self._save_index_snapshot(self._indices)
+    
+    def _rows_missing_from(self, table, columns, ids):
+        # type: (str, str, intbitset) -> List[tuple]
+        """
+        Get the `columns` of the rows of `table` whose ids aren't in `ids`.
+        Rows past the max id are found directly.  If any others are missing,
+        e.g. inserted by another process from an earlier block of ids, all ids are compared.
+        """
+        max_id = ids[-1] if ids else 0
+        rows = self.db.cursor.execute(
+                'SELECT {} FROM {} WHERE id > ?'.format(columns, table), [max_id]).fetchall()
+        self.db.cursor.execute('SELECT COUNT(*) FROM {}'.format(table))
+        if self.db.cursor.fetchone()[0] <= len(ids) + len(rows):
+            return rows
+        missing_ids = list(intbitset(self.db.cursor.execute(
+                'SELECT id FROM {} WHERE id <= ?'.format(table), [max_id]).fetchall()) - ids)
+        # stay under SQLite's limit on the number of query parameters
+        for i in xrange(0, len(missing_ids), 500):
+            chunk = missing_ids[i:i + 500]
+            rows.extend(self.db.cursor.execute(
+                    'SELECT {} FROM {} WHERE id IN ({})'
+                        .format(columns, table, ', '.join('?' * len(chunk))),
+                    chunk))
+        return rows
+    
+    def _catch_up_indices(self):
+        # type: () -> intbitset
+        """
+        Add the questions and songs other processes inserted to the in-memory indices,
+        and return the ids of the questions added.
+        """
+        question_index, song_ids = self.in_memory_indices()
+        with self.reading():
+            new_questions = self._rows_missing_from(
+                    'questions', 'id, type, difficulty, category', question_index.ids())
+            new_songs = self._rows_missing_from('songs', 'id', song_ids)
+        question_index.add_all(new_questions)
+        song_ids.update([song_id for song_id, in new_songs])
+        return intbitset([question_id for question_id, type, difficulty, category in new_questions])
+    
+    @property
+    def _question_index(self):
+        # type: () -> QuestionIndex
+        return self.in_memory_indices()[0]
+    
+    @property
+    def _song_ids(self):
+        # type: () -> intbitset
+        return self.in_memory_indices()[1]
+    
+    def _finish_at_exit(self):
+        # type: () -> None
+        # forked workers inherit the handler of the DB preload() closed, which must stay closed
+        if not self._closed:
+            self._user_stats.close()
+            self.save_index_snapshot()
+    
+    def close(self):
+        # type: () -> None
+        """Flush buffered user stats and save the index snapshot, then close and commit DB."""
+        self._closed = True
+        self._user_stats.close()
+        self.save_index_snapshot()
+        super(ListenUpDatabase, self).close()
+    
+    def clear(self):
+        # type: () -> None
+        """Drop and recreate tables, forgetting all state loaded from them and the index snapshot."""
+        self._user_stats.flush()
+        super(ListenUpDatabase, self).clear()
+        with self._indices_lock:
+            self._indices = None
+            self._snapshot_watermarks = None
+            io.remove_if_exists(self.index_snapshot_path)
+        with self._question_ids_lock:
+            self._next_question_ids = iter(())
+        self._exhausted_options.clear()
+        self.prefetcher.clear()
+    
+    def _migrate(self):
+        # type: () -> None
+        self._migrate_content_keys()
+        self._migrate_usernames()
+    
+    def _migrate_usernames(self):
+        # type: () -> None
+        """Make usernames unique for DBs created before the users_username index existed."""
+        self.db.cursor.execute('SELECT COUNT(*) FROM sqlite_master '
+                               'WHERE type = \'index\' AND name = \'users_username\'')
+        if self.db.cursor.fetchone()[0] > 0:
+            return
+        # duplicate accounts couldn't be logged into anyway, since logging in finds the first
+        self.db.cursor.execute('UPDATE users SET username = username || \'#\' || id '
+                               'WHERE id NOT IN (SELECT MIN(id) FROM users GROUP BY username)')
+    
+    def _migrate_content_keys(self):
+        # type: () -> None
+        """Add and backfill questions.content_key for DBs created before it existed."""
+        if self.db.column_exists('questions', 'content_key'):
+            return
+        self.db.cursor.execute('ALTER TABLE questions ADD COLUMN content_key TEXT')
+        keys = {}  # type: Dict[str, int]
+        for row in self.db.cursor.execute(
                 'SELECT id, question, answer, choices, '
-                'type, difficulty, category, audio_path FROM questions'):
-            yield Question.from_db(id, question, answer, choices,
-                                   type, difficulty, category, audio_path)
+                'type, difficulty, category, audio_path FROM questions ORDER BY id').fetchall():
+            # if there are already duplicates, only the first one gets the unique key
+            keys.setdefault(Question.from_db(*row).content_key(), row[0])
+        self.db.cursor.executemany('UPDATE questions SET content_key = ? WHERE id = ?',
+                                   keys.viewitems())
     
     def _get_all_song_ids(self):
         # type: () -> intbitset
         """Get all song ids in DB."""
         return intbitset(self.db.cursor.execute('SELECT id FROM songs').fetchall())
     
+    # Meta stuff
+    
+    def _get_meta(self, key, default=None):
+        # type: (str, Any) -> Any
+        """Get the value of `key` in the meta table."""
+        self.db.cursor.execute('SELECT value FROM meta WHERE key = ?', [key])
+        result = self.db.cursor.fetchone()
+        return default if result is None else result[0]
+    
+    def _set_meta(self, key, value):
+        # type: (str, Any) -> None
+        """Set `key` to `value` in the meta table.  Must be on the writer path."""
+        self.db.cursor.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', [key, value])
+    
+    def _get_db_id(self):
+        # type: () -> str
+        """Get the random id of this DB, which changes when it's cleared or replaced."""
+        with self.writing():
+            self.db.cursor.execute('INSERT OR IGNORE INTO meta VALUES (?, ?)',
+                                   ['db_id', uuid.uuid4().hex])
+            return self._get_meta('db_id')
+    
+    # Audio stuff
+    
+    def _buffered_audio_paths(self):
+        # type: () -> Set[str]
+        """Get the audio paths of the questions in users' prefetch buffers."""
+        question_ids = list(self.prefetcher.buffered_question_ids())
+        paths = set()  # type: Set[str]
+        with self.reading():
+            # stay under SQLite's limit on the number of query parameters
+            for i in xrange(0, len(question_ids), 500):
+                ids = question_ids[i:i + 500]
+                paths.update(path for path, in self.db.cursor.execute(
+                        'SELECT audio_path FROM questions WHERE id IN ({})'
+                            .format(', '.join('?' * len(ids))),
+                        ids))
+        return paths
+    
+    def _ensure_audio(self, table, item, dir_path):
+        # type: (str, Union[Question, Song], str) -> None
+        """
+        Mark `item`'s audio as just served, re-synthesizing it if it was evicted
+        and updating its audio_path in `table` if that changed.
+        """
+        if self.audio_store.touch(item.audio_path):
+            return
+        self._synthesize_audio(table, item, dir_path)
+    
+    def _synthesize_audio(self, table, item, dir_path):
+        # type: (str, Union[Question, Song], str) -> None
+        """
+        Synthesize `item`'s audio, updating its audio_path in `table` if that changed.
+        Concurrent calls for the same item share one synthesis.
+        """
+        old_audio_path = item.audio_path
+        
+        def synthesize():
+            # type: () -> str
+            item.download_audio(dir_path)
+            if item.audio_path != old_audio_path:
+                with self.writing():
+                    self.db.cursor.execute(
+                            'UPDATE {} SET audio_path = ? WHERE id = ?'.format(table),
+                            [item.audio_path, item.id])
+            # only add it after its audio_path is updated, so it's recognized as pinned
+            self.audio_store.add(item.audio_path)
+            return item.audio_path
+        
+        item.audio_path = self._single_flight.do(('synthesize_audio', table, item.id), synthesize)
+    
+    def restore_audio(self, audio_path):
+        # type: (str) -> Union[str, None]
+        """
+        Ensure the audio of the question or song whose audio was at `audio_path`,
+        re-synthesizing it if it was evicted.
+        Return its current audio path, or None if no question or song has that audio path.
+        """
+        with self.reading():
+            question = self.db.cursor.execute(
+                    'SELECT id, question, answer, choices, '
+                    'type, difficulty, category, audio_path '
+                    'FROM questions WHERE audio_path = ? LIMIT 1',
+                    [audio_path]
+            ).fetchone()  # type: Tuple[int, unicode, unicode, unicode, unicode, unicode, unicode, str]
+            song = None  # type: Tuple[int, unicode, unicode, unicode, str]
+            if question is None:
+                song = self.db.cursor.execute(
+                        'SELECT id, name, artist, lyrics, audio_path FROM songs WHERE audio_path = ?',
+                        [audio_path]
+                ).fetchone()
+        if question is not None:
+            item = Question.from_db(*question)  # type: Union[Question, Song]
+            self._ensure_audio('questions', item, self.questions_dir)
+        elif song is not None:
+            song_id, name, artist, lyrics, song_audio_path = song
+            item = Song(song_id, artist, name, lyrics, song_audio_path)
+            self._ensure_audio('songs', item, self.songs_dir)
+        else:
+            return None
+        return item.audio_path
+    
+    # Background stuff
+    
+    def run_in_background(self, runnable, name=None, key=None):
+        # type: (Callable[[], Any], str, Hashable) -> bool
+        """Run `runnable` in the background, making its API requests at background priority."""
+        if name is None:
+            name = runnable.func_name
+        
+        def background_runnable():
+            # type: () -> None
+            with rate_limit.background_priority():
+                runnable()
+        
+        return super(ListenUpDatabase, self).run_in_background(background_runnable, name, key)
+    
+    def prefetch_session_token(self):
+        # type: () -> bool
+        """Get the trivia session token in the background, so downloads don't wait for it."""
+        return self.run_in_background(trivia.session_token.get, name='trivia_session_token')
+    
     # User stuff
     
     def get_user(self, username, password):
@@ -98,16 +494,25 @@ class ListenUpDatabase(ApplicationDatabase):
         If `username` doesn't exist or `password` doesn't match,
         raise an `self.exception` with a message.
         """
-        self.db.cursor.execute(
-                'SELECT id, password, points, questions, songs FROM users WHERE username = ?',
-                [username])
-        result = self.db.cursor.fetchone()  # type: Tuple[int, unicode, int, buffer, buffer]
+        with self.reading():
+            self.db.cursor.execute(
+                    'SELECT id, password, points, questions, songs FROM users WHERE username = ?',
+                    [username])
+            result = self.db.cursor.fetchone()  # type: Tuple[int, unicode, int, buffer, buffer]
         if result is None:
             raise self.exception('username "{}" doesn\'t exist'.format(username))
         user_id, hashed_password, points, questions, songs = result
         if not verify_password(password, hashed_password):
             raise self.exception('wrong password for username "{}"'.format(username))
-        return User.from_db(user_id, username, points, questions, songs)
+        user = User.from_db(user_id, username, points, questions, songs)
+        buffered_user = self._user_stats.get(user_id)  # type: User
+        if buffered_user is not None:
+            # stats not written yet are newer than the DB's
+            user.points = buffered_user.points
+            user.questions = intbitset(buffered_user.questions)
+            user.songs = intbitset(buffered_user.songs)
+            user.starting_points = user.points
+        return user
     
     def verify_user(self, username, password):
         # type: (unicode, unicode) -> bool
@@ -117,19 +522,20 @@ class ListenUpDatabase(ApplicationDatabase):
     def user_exists(self, username):
         # type: (unicode) -> bool
         """Check if User with `username` exists."""
-        self.db.cursor.execute('SELECT id FROM users WHERE username = ?', [username])
-        return self.db.result_exists()
+        with self.reading():
+            self.db.cursor.execute('SELECT id FROM users WHERE username = ?', [username])
+            return self.db.result_exists()
     
     def _add_user_hard(self, username, password):
         # type: (unicode, unicode) -> User
         points = 0
         empty_buf = buffer(intbitset().fastdump())
-        self.db.cursor.execute(
-                'INSERT INTO users VALUES (NULL, ?, ?, ?, ?, ?)',
-                [username, hash_password(password), points, empty_buf, empty_buf]
-        )
-        user_id = self.db.cursor.lastrowid
-        self.commit()
+        with self.writing():
+            self.db.cursor.execute(
+                    'INSERT INTO users VALUES (NULL, ?, ?, ?, ?, ?)',
+                    [username, hash_password(password), points, empty_buf, empty_buf]
+            )
+            user_id = self.db.cursor.lastrowid
         return User(user_id, username, points, intbitset(), intbitset())
     
     def add_user(self, username, password):
@@ -140,102 +546,334 @@ class ListenUpDatabase(ApplicationDatabase):
         If `User` with `username` already exists,
         raise an `self.exception`.
         """
-        if self.user_exists(username):
-            raise self.exception('username "{}" already exists'.format(username))
-        return self._add_user_hard(username, password)
+        # check and insert on the writer, so two signups can't both pass the check
+        with self.writing():
+            if self.user_exists(username):
+                raise self.exception('username "{}" already exists'.format(username))
+            return self._add_user_hard(username, password)
     
     def update_password(self, user, password):
         # type: (User, unicode) -> None
         """Update password to `password` for `user`."""
-        self.db.cursor.execute('UPDATE users SET password = ? WHERE id = ?',
-                               [hash_password(password), user.id])
-        self.commit()
+        with self.writing():
+            self.db.cursor.execute('UPDATE users SET password = ? WHERE id = ?',
+                                   [hash_password(password), user.id])
+    
+    def _write_user_stats(self, users):
+        # type: (Iterable[User]) -> None
+        """
+        Write stats of all `users` in a single transaction, merged with their stats in the DB,
+        which other processes may have written more recently.
+        Points only ever increase and questions and songs are only ever added,
+        so merging keeps the max points and the union of questions and songs.
+        """
+        with self.writing():
+            rows = []  # type: List[list]
+            for user in users:
+                self.db.cursor.execute('SELECT points, questions, songs FROM users WHERE id = ?',
+                                       [user.id])
+                result = self.db.cursor.fetchone()  # type: Tuple[int, buffer, buffer]
+                if result is None:
+                    continue
+                merged = User.from_db(user.id, user.username, *result)
+                merged.points = max(merged.points, user.points)
+                merged.questions |= user.questions
+                merged.songs |= user.songs
+                rows.append([merged.points, merged.serialize_questions(), merged.serialize_songs(),
+                             user.id])
+            self.db.cursor.executemany(
+                    'UPDATE users SET points = ?, questions = ?, songs = ? WHERE id = ?', rows)
     
     def update_user_stats(self, user):
         # type: (User) -> None
-        """Update `user`'s stats in DB according to fields of `user` (not username or password)."""
-        self.db.cursor.execute(
-                'UPDATE users SET points = ?, questions = ?, songs = ? WHERE id = ?',
-                [user.points, user.serialize_questions(), user.serialize_songs(), user.id]
-        )
-        self.commit()
+        """
+        Update `user`'s stats in DB according to fields of `user` (not username or password).
+        The update is buffered and written behind, see `flush_user_stats()`.
+        """
+        self._user_stats.put(user.id, user)
+    
+    def flush_user_stats(self, user=None):
+        # type: (User) -> None
+        """Write buffered stats now, for all users or only `user`, e.g. on logout."""
+        self._user_stats.flush(None if user is None else [user.id])
     
     # Question stuff
     
-    def _yield_questions(self, questions, last_question_id):
-        # type: (Iterable[Question], int) -> Iterable[Question]
-        """Yield each question, downloading audio and setting id first."""
-        for i, question in enumerate(questions):
-            question.id = i + last_question_id + 1
+    def _next_question_id(self):
+        # type: () -> int
+        """
+        Reserve a new question id.
+        Ids are reserved from the DB in blocks, so they're unique across threads and processes
+        without holding the writer for every question.
+        """
+        with self._question_ids_lock:
+            question_id = next(self._next_question_ids, None)
+            if question_id is None:
+                block_size = ListenUpDatabase.QUESTION_ID_BLOCK_SIZE
+                with self.writing():
+                    start = max(self._get_meta('next_question_id', 1),
+                                (self.db.max_rowid('questions') or 0) + 1)  # type: int
+                    self._set_meta('next_question_id', start + block_size)
+                self._next_question_ids = iter(xrange(start, start + block_size))
+                question_id = next(self._next_question_ids)
+            return question_id
+    
+    def _prepare_question(self, question):
+        # type: (Question) -> Question
+        """
+        Reserve an id for `question` and download its audio if `eager_audio`,
+        or else mark its audio as pending.  Runs outside any DB lock.
+        """
+        question.id = self._next_question_id()
+        if self.eager_audio:
             question.download_audio(self.questions_dir)
-            question.serialize_choices()
-            yield question
+            self.audio_store.add(question.audio_path)
+        else:
+            question.audio_path = ListenUpDatabase.PENDING_AUDIO_PATH
+        return question
     
     def _insert_questions(self, questions):
-        # type: (Iterable[Question]) -> None
-        last_question_id = self.db.max_rowid('questions') or 0  # type: int
-        self.db.cursor.executemany(
-                'INSERT INTO questions VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
-                (question.as_tuple() for question in
-                 self._yield_questions(questions, last_question_id))
-        )
-        self.commit()
-    
-    def _get_new_questions(self, user, num_questions):
-        # type: (User, int) -> Set[Question]
-        """Get exactly `num_questions` new, unique questions."""
-        original_questions = list(get_questions(user.options, num_questions))
-        new_questions = set(original_questions) - self._questions
-        self._questions.update(new_questions)
-        skipped = len(original_questions) - len(new_questions)
-        if skipped > 0:
-            new_questions.update(self._get_new_questions(user, skipped))
-        return new_questions
+        # type: (Iterable[Question]) -> List[Question]
+        """
+        Insert `questions` (with ids) in one transaction,
+        ignoring any already in the DB, and return the inserted ones.
+        """
+        inserted = []  # type: List[Question]
+        ignored = []  # type: List[Question]
+        with self.writing():
+            for question in questions:
+                content_key = question.content_key()
+                question.serialize_choices()
+                self.db.cursor.execute(
+                        'INSERT OR IGNORE INTO questions (id, question, answer, choices, '
+                        'type, difficulty, category, audio_path, content_key) '
+                        'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                        question.as_tuple() + (content_key,)
+                )
+                (inserted if self.db.cursor.rowcount > 0 else ignored).append(question)
+        for question in inserted:
+            self._question_index.add_question(question)
+        for question in ignored:
+            if question.audio_path != ListenUpDatabase.PENDING_AUDIO_PATH:
+                # inserted concurrently by someone else, so this audio isn't needed
+                io.remove_if_exists(question.audio_path)
+                self.audio_store.discard(question.audio_path)
+        return inserted
+    
+    def _existing_content_keys(self, keys):
+        # type: (Iterable[str]) -> Set[str]
+        """Get which of the question content `keys` are already in the DB."""
+        keys = list(keys)
+        if not keys:
+            return set()
+        with self.reading():
+            return {key for key, in self.db.cursor.execute(
+                    'SELECT content_key FROM questions WHERE content_key IN ({})'
+                        .format(', '.join('?' * len(keys))),
+                    keys)}
+    
+    def _remaining_questions(self, options):
+        # type: (QuestionOptions) -> Union[int, None]
+        """
+        Get an upper bound of the number of questions with `options` not in the DB yet,
+        or None if it's unknown.
+        """
+        try:
+            num_available = trivia.question_count(options)  # type: int
+        except (RequestException, KeyError, ValueError):
+            return None
+        if num_available is None:
+            return None
+        return num_available - len(self._question_index.get(options))
+    
+    def _get_new_questions(self, options, num_questions):
+        # type: (QuestionOptions, int) -> Iterable[Question]
+        """
+        Yield up to `num_questions` new questions with `options`, unique and not already in the DB,
+        as soon as each batch is downloaded.
+        
+        Stops early, after at most `MAX_DOWNLOAD_ROUNDS` requests,
+        once the pool of questions with `options` is exhausted,
+        or when a request fails after earlier rounds already yielded questions,
+        so those still get inserted.  A failure of the first round is raised.
+        """
+        exhausted_time = self._exhausted_options.get(options.as_tuple(), 0)
+        if time.time() - exhausted_time < ListenUpDatabase.EXHAUSTED_TTL:
+            return
+        new_keys = set()  # type: Set[str]
+        max_amount = self._remaining_questions(options)  # type: int
+        for _ in xrange(ListenUpDatabase.MAX_DOWNLOAD_ROUNDS):
+            amount = num_questions - len(new_keys)
+            if max_amount is not None:
+                amount = min(amount, max_amount - len(new_keys))
+            if amount <= 0:
+                if max_amount is not None and len(new_keys) >= max_amount:
+                    self._exhausted_options[options.as_tuple()] = time.time()
+                break
+            try:
+                downloaded = OrderedDict(
+                        (question.content_key(), question) for question in
+                        get_questions(options, amount)
+                )  # type: Dict[str, Question]
+            except trivia.NotEnoughQuestionsException:
+                # fewer questions left than asked for, so try asking for fewer
+                max_amount = len(new_keys) + amount // 2
+                continue
+            except (RequestException, trivia.TriviaException, KeyError, ValueError):
+                if not new_keys:
+                    raise
+                break
+            if not downloaded:
+                break
+            existing_keys = self._existing_content_keys(downloaded.viewkeys())
+            for key, question in downloaded.viewitems():
+                if key not in existing_keys and key not in new_keys:
+                    new_keys.add(key)
+                    yield question
     
     def add_questions(self, user, num_questions=None):
-        # type: (User, int) -> None
+        # type: (User, int) -> List[Question]
         """Add `num_questions` `Question`s to DB according to `user`'s options."""
+        return self.download_questions(user.options, num_questions)
+    
+    def download_questions(self, options, num_questions=None):
+        # type: (QuestionOptions, int) -> List[Question]
+        """
+        Add `num_questions` `Question`s with `options` to DB and return the ones added.
+        
+        Questions flow through a pipeline: they're downloaded from the trivia API,
+        if `eager_audio`, their audio is synthesized on `synthesis_parallelism` threads
+        (the bounded queue in between throttles downloading),
+        and then they're all inserted in a single transaction,
+        which is the only time the writer is held.
+        
+        Concurrent downloads for the same options share one download and all return its questions.
+        """
         if num_questions is None:
             num_questions = ListenUpDatabase.DEFAULT_BUF_SIZE
-        self._insert_questions(self._get_new_questions(user, num_questions))
+        return self._single_flight.do(('download_questions', options.as_tuple()),
+                                      lambda: self._download_questions(options, num_questions))
+    
+    def _download_questions(self, options, num_questions):
+        # type: (QuestionOptions, int) -> List[Question]
+        # other processes may have downloaded some already
+        num_questions -= len(self._catch_up_indices() & self._question_index.get(options))
+        if num_questions <= 0:
+            return []
+        parallelism = self.synthesis_parallelism if self.eager_audio else 1
+        questions = parallel_map(self._prepare_question,
+                                 self._get_new_questions(options, num_questions),
+                                 parallelism)  # type: List[Question]
+        return self._insert_questions(questions)
     
     def get_question(self, question_id):
         # type: (int) -> Question
         """Get `Question` with `question_id`."""
-        self.db.cursor.execute(
-                'SELECT question, answer, choices, '
-                'type, difficulty, category, audio_path '
-                'FROM questions WHERE id = ?',
-                [question_id]
-        )
-        result = self.db.cursor.fetchone()  # type: Tuple[unicode, unicode, unicode, unicode, unicode, unicode, str]
+        with self.reading():
+            self.db.cursor.execute(
+                    'SELECT question, answer, choices, '
+                    'type, difficulty, category, audio_path '
+                    'FROM questions WHERE id = ?',
+                    [question_id]
+            )
+            result = self.db.cursor.fetchone()  # type: Tuple[unicode, unicode, unicode, unicode, unicode, unicode, str]
+        if result is None:
+            raise self.exception('no question with id {}'.format(question_id))
         return Question.from_db(*((question_id,) + result))
     
-    # FIXME needs to get question based on options
-    # FIXME so must query all the matching DB rows
-    # FIXME and then filter out already used ones
+    def _unanswered_question_ids(self, user):
+        # type: (User) -> intbitset
+        """Get ids of questions matching `user`'s options that `user` hasn't answered yet."""
+        # filtering possible question ids using fast intbitsets from the in-memory index,
+        # rather than running a complicated and slow SQL query.
+        return self._question_index.get(user.options) - user.questions
+    
     def next_question(self, user):
         # type: (User) -> Question
-        """Get next `Question` for `user` that `user` hasn't answered before."""
-        question_ids = user.questions  # type: intbitset
-        max_question_id = self.db.max_rowid('questions') or 0  # type: int
-        # filtering possible question ids using fast intbitset in Python,
-        # rather than running a complicated and slow SQL query.
-        # will be performant if question_ids are dense, meaning few deleted questions
-        question_id = next(
-                (id for id in xrange(1, max_question_id + 1) if
-                 id not in question_ids),
-                max_question_id + 1)  # type: int
-        user.last_question_id = question_id
-        if question_id > max_question_id:
+        """Get next `Question` matching `user`'s options that `user` hasn't answered before."""
+        return self.next_questions(user, 1)[0]
+    
+    def next_questions(self, user, num_questions):
+        # type: (User, int) -> List[Question]
+        """
+        Get the next `num_questions` `Question`s (or as many as are left, but at least one)
+        matching `user`'s options that `user` hasn't answered before, with their audio ready.
+        """
+        question_ids = self._unanswered_question_ids(user)  # type: intbitset
+        if not question_ids:
+            # other processes may have downloaded some
+            self._catch_up_indices()
+            question_ids = self._unanswered_question_ids(user)
+        if not question_ids:
             # if there are no questions left, download immediately
-            self.add_questions(user)
-            
-        if question_id + ListenUpDatabase.DEFAULT_BUF_SIZE > max_question_id:
-            # if there are only a few questions left, download in background
-            self.run_in_background(lambda: self.add_questions(user), name='download_questions')
+            question_ids = self._download_unanswered_question_ids(user)
+        user.last_question_id = question_ids[0]
+        self.prefetcher.buffer(user.id, question_ids)
+        # if there are only a few questions left, download more in background
+        self.prefetcher.served(user.options, max(len(question_ids) - num_questions, 0))
+        with self.reading():
+            questions = [self.get_question(question_id)
+                         for question_id in question_ids[:num_questions]]  # type: List[Question]
+        
+        def ensure_audio(question):
+            # type: (Question) -> None
+            # synthesizes the audio if it's still pending
+            self._ensure_audio('questions', question, self.questions_dir)
+        
+        parallel_map(ensure_audio, questions, min(len(questions), self.synthesis_parallelism))
+        self._synthesize_lookahead(
+                user, list(question_ids[num_questions:num_questions + self.audio_lookahead]))
+        return questions
+    
+    @staticmethod
+    def _widened_options(options):
+        # type: (QuestionOptions) -> Iterator[QuestionOptions]
+        """Yield `options`, then wider and wider options, dropping type, difficulty, and category."""
+        yield options
+        fields = list(options.as_tuple())
+        for i, value in enumerate(fields):
+            if value:
+                fields[i] = None
+                yield QuestionOptions(*fields)
+    
+    def _download_unanswered_question_ids(self, user):
+        # type: (User) -> intbitset
+        """
+        Download questions `user` hasn't answered and return their ids.
+        If there are no more questions with `user`'s options, widen the options.
+        """
+        for options in self._widened_options(user.options):
+            question_ids = self._question_index.get(options) - user.questions  # type: intbitset
+            if not question_ids:
+                self.download_questions(options)
+                question_ids = self._question_index.get(options) - user.questions
+            if question_ids:
+                return question_ids
+        raise self.exception('no new questions for {}'.format(user.options))
+    
+    def _synthesize_lookahead(self, user, question_ids):
+        # type: (User, List[int]) -> bool
+        """
+        Synthesize the pending audio of the next `question_ids` `user` will be served
+        in the background, so it's ready before they get there.
+        """
+        if not question_ids:
+            return False
         
-        return self.get_question(question_id)
+        def synthesize_lookahead():
+            # type: () -> None
+            for question_id in question_ids:
+                question = self.get_question(question_id)
+                if not os.path.exists(question.audio_path):
+                    self._synthesize_audio('questions', question, self.questions_dir)
+        
+        return self.run_in_background(synthesize_lookahead, name='synthesize_lookahead',
+                                      key=('synthesize_lookahead', user.id))
+    
+    def prefetch_questions(self, user):
+        # type: (User) -> None
+        """Download questions in the background if `user` is running low, e.g. on new options."""
+        self.prefetcher.prefetch(user.options, len(self._unanswered_question_ids(user)))
     
     def complete_question(self, user, question):
         # type: (User, Question) -> None
@@ -243,16 +881,38 @@ class ListenUpDatabase(ApplicationDatabase):
         user.complete_question(question)
         self.update_user_stats(user)
     
+    def answer_questions(self, user, answers):
+        # type: (User, Iterable[Tuple[int, unicode]]) -> List[bool]
+        """
+        Check `user`'s (question id, answer) `answers`, completing the questions answered correctly,
+        and return which answers were correct.
+        Questions `user` already completed don't count again.
+        If any question doesn't exist, raise before completing any.
+        """
+        answers = list(answers)
+        with self.reading():
+            questions = [self.get_question(question_id)
+                         for question_id, answer in answers]  # type: List[Question]
+        results = []  # type: List[bool]
+        for question, (question_id, answer) in zip(questions, answers):
+            correct = answer == question.answer
+            if correct and question.id not in user.questions:
+                self.complete_question(user, question)
+            results.append(correct)
+        return results
+    
     # Song stuff
     
     def _insert_song(self, song):
         # type: (Song) -> bool
         """Insert `song` into DB and return true if it is a new, unique song and was inserted."""
         try:
-            self.db.cursor.execute('INSERT INTO songs VALUES (?, ?, ?, ?, ?)', song.as_tuple())
+            with self.writing():
+                self.db.cursor.execute('INSERT INTO songs VALUES (?, ?, ?, ?, ?)',
+                                       song.as_tuple())
         except IntegrityError:
             return False
-        self.commit()
+        self._song_ids.add(song.id)
         return True
     
     def next_song(self, user, record=True):
@@ -262,17 +922,23 @@ class ListenUpDatabase(ApplicationDatabase):
         If `record`, call play_song() for the song and `user`.
         """
         new_song_ids = self._song_ids - user.songs  # type: intbitset
+        if len(new_song_ids) == 0:
+            # other processes may have downloaded some
+            self._catch_up_indices()
+            new_song_ids = self._song_ids - user.songs
         if len(new_song_ids) == 0:
             song = self.new_song()
         else:
             song_id = new_song_ids[random.randrange(0, len(new_song_ids))]
-            self.db.cursor.execute(
-                    'SELECT name, artist, lyrics, audio_path FROM songs WHERE id = ?',
-                    [song_id]
-            )
-            result = self.db.cursor.fetchone()  # type: Tuple[unicode, unicode, unicode, str]
+            with self.reading():
+                self.db.cursor.execute(
+                        'SELECT name, artist, lyrics, audio_path FROM songs WHERE id = ?',
+                        [song_id]
+                )
+                result = self.db.cursor.fetchone()  # type: Tuple[unicode, unicode, unicode, str]
             name, artist, lyrics, audio_path = result
             song = Song(song_id, artist, name, lyrics, audio_path)
+            self._ensure_audio('songs', song, self.songs_dir)
         
         if len(new_song_ids) <= 1:
             self.run_in_background(lambda: self.new_song(), name='download_song')
@@ -281,20 +947,75 @@ class ListenUpDatabase(ApplicationDatabase):
             self.play_song(user, song)
         return song
     
+    def _fetch_chart_pages(self, first_page, last_page):
+        # type: (int, int) -> int
+        """
+        Fetch chart pages `first_page` to `last_page` into the chart snapshot
+        and return the number of chart entries fetched.
+        """
+        page_size = ListenUpDatabase.CHART_PAGE_SIZE
+        entries = []  # type: List[Tuple[int, int, unicode, unicode]]
+        for page in xrange(first_page, last_page + 1):
+            # a stale cached chart would undo refreshing the snapshot every CHART_TTL
+            chart = music.get_chart(page, page_size, max_stale=ListenUpDatabase.CHART_TTL)
+            entries.extend((rank, track_id, artist, name) for rank, (track_id, artist, name) in
+                           enumerate(chart, (page - 1) * page_size + 1))
+        if not entries:
+            return 0
+        with self.writing():
+            if first_page == 1:
+                self.db.cursor.execute('DELETE FROM chart')
+                self._set_meta('chart_fetched_at', time.time())
+            self.db.cursor.executemany('INSERT OR REPLACE INTO chart VALUES (?, ?, ?, ?)',
+                                       entries)
+            # the cursor: number of chart pages in the snapshot
+            self._set_meta('chart_pages', last_page)
+        return len(entries)
+    
+    def _next_chart_entry(self):
+        # type: () -> Tuple[int, unicode, unicode]
+        """Get the (track_id, artist, name) of the highest ranked chart song not in the DB."""
+        with self.reading():
+            self.db.cursor.execute(
+                    'SELECT track_id, artist, name FROM chart '
+                    'WHERE track_id NOT IN (SELECT id FROM songs) ORDER BY rank LIMIT 1')
+            return self.db.cursor.fetchone()
+    
     def new_song(self):
         # type: () -> Song
-        """Get the next `Song` not in the DB.  Then insert it."""
-        # Keep getting next songs until a new one is found.
-        new_song_num = len(self._song_ids) + 1
+        """
+        Get the highest ranked `Song` in the Musixmatch chart not in the DB.  Then insert it.
+        
+        Songs are picked from a local chart snapshot that's refreshed every `CHART_TTL` seconds
+        and extended a page at a time when all of its songs are already in the DB.
+        
+        Concurrent calls share one download and all return the same song.
+        """
+        return self._single_flight.do('new_song', self._new_song)
+    
+    def _new_song(self):
+        # type: () -> Song
+        with self.reading():
+            fetched_at = self._get_meta('chart_fetched_at', 0)  # type: float
+            num_pages = self._get_meta('chart_pages', 0)  # type: int
+        if time.time() - fetched_at > ListenUpDatabase.CHART_TTL:
+            num_pages = max(num_pages, 1)
+            self._fetch_chart_pages(1, num_pages)
+        
         while True:
-            song = Song.get_song(new_song_num, self.songs_dir)
-            if self._insert_song(song):
-                return song
-            # try next song if previous one already is in DB
-            # which may happen because song rankings will change over time
-            # TODO if this happens a lot, new_song_num will have to be maintained separately from
-            # TODO the number of songs already in DB, b/c they will be out of sync
-            new_song_num += 1
+            entry = self._next_chart_entry()
+            if entry is not None:
+                break
+            num_pages += 1
+            if self._fetch_chart_pages(num_pages, num_pages) == 0:
+                raise self.exception('no new songs left in the chart')
+        
+        track_id, artist, name = entry
+        song = Song.from_chart(track_id, artist, name, self.songs_dir)
+        self.audio_store.add(song.audio_path)
+        # if it isn't inserted, it was just inserted concurrently, which is fine
+        self._insert_song(song)
+        return song
     
     def play_song(self, user, song):
         # type: (User, Song) -> None
@@ -0,0 +1,162 @@
+import math
+import threading
+import time
+from intbitset import intbitset
+from itertools import islice
+
+from typing import Any, Dict, Tuple
+
+from core.question_options import QuestionOptions
+
+
+class _OptionsState(object):
+    """
+    Prefetching state of one `QuestionOptions` combination.
+
+    :ivar count: exponentially decaying count of questions served,
+        divided by `QuestionPrefetcher.RATE_TIME_CONSTANT` to get questions per second
+    :type count: float
+
+    :ivar last_served: time a question was last served
+    :type last_served: float
+
+    :ivar refill_time: moving average of how many seconds a refill takes
+    :type refill_time: float
+    """
+
+    def __init__(self, now):
+        # type: (float) -> None
+        self.count = 0.0
+        self.last_served = now
+        self.refill_time = QuestionPrefetcher.INITIAL_REFILL_TIME
+
+    def serve(self, now):
+        # type: (float) -> None
+        decay = math.exp(-(now - self.last_served) / QuestionPrefetcher.RATE_TIME_CONSTANT)
+        self.count = self.count * decay + 1
+        self.last_served = now
+
+    def rate(self, now):
+        # type: (float) -> float
+        """Questions served per second."""
+        decay = math.exp(-(now - self.last_served) / QuestionPrefetcher.RATE_TIME_CONSTANT)
+        return self.count * decay / QuestionPrefetcher.RATE_TIME_CONSTANT
+
+
+class QuestionPrefetcher(object):
+    """
+    Keeps unanswered, ready-to-serve questions buffered for each active `QuestionOptions`.
+
+    When a user has fewer than `low_watermark` questions left for their options,
+    a background refill tops them up to `high_watermark`,
+    plus the number of questions those options are expected to consume during the refill,
+    estimated from their observed consumption rate.
+
+    :ivar db: DB to download questions into
+    :type db: ListenUpDatabase
+
+    :ivar low_watermark: buffered questions below which a refill is scheduled
+    :type low_watermark: int
+
+    :ivar high_watermark: buffered questions a refill aims for
+    :type high_watermark: int
+
+    :ivar max_refill: max questions downloaded by a single refill
+    :type max_refill: int
+    """
+
+    DEFAULT_LOW_WATERMARK = 5  # type: int
+    DEFAULT_HIGH_WATERMARK = 15  # type: int
+    DEFAULT_MAX_REFILL = 50  # type: int
+
+    RATE_TIME_CONSTANT = 60.0  # type: float
+    INITIAL_REFILL_TIME = 5.0  # type: float
+    ACTIVE_TIME = 15 * 60.0  # type: float
+
+    def __init__(self, db, low_watermark=DEFAULT_LOW_WATERMARK,
+                 high_watermark=DEFAULT_HIGH_WATERMARK, max_refill=DEFAULT_MAX_REFILL):
+        # type: (Any, int, int, int) -> None
+        self.db = db
+        self.low_watermark = low_watermark
+        self.high_watermark = high_watermark
+        self.max_refill = max_refill
+        self._states = {}  # type: Dict[Tuple[str, str, str], _OptionsState]
+        # each user's next question ids, and when they were buffered
+        self._buffers = {}  # type: Dict[int, Tuple[float, intbitset]]
+        self._lock = threading.Lock()
+
+    def _state(self, options, now):
+        # type: (QuestionOptions, float) -> _OptionsState
+        key = options.as_tuple()
+        state = self._states.get(key)
+        if state is None:
+            state = self._states[key] = _OptionsState(now)
+        return state
+
+    def refill_size(self, options, num_buffered):
+        # type: (QuestionOptions, int) -> int
+        """Number of questions to download for `options` when `num_buffered` are left."""
+        now = time.time()
+        with self._lock:
+            state = self._state(options, now)
+            expected_consumption = state.rate(now) * state.refill_time
+        size = self.high_watermark - num_buffered + int(math.ceil(expected_consumption))
+        return max(1, min(size, self.max_refill))
+
+    def served(self, options, num_buffered):
+        # type: (QuestionOptions, int) -> None
+        """Record that a question for `options` was served, leaving `num_buffered`."""
+        now = time.time()
+        with self._lock:
+            self._state(options, now).serve(now)
+        self.prefetch(options, num_buffered)
+
+    def prefetch(self, options, num_buffered):
+        # type: (QuestionOptions, int) -> bool
+        """
+        Refill `options` in the background if `num_buffered` is below the low watermark.
+        Return True if a refill was scheduled.
+        """
+        if num_buffered >= self.low_watermark:
+            return False
+        options = QuestionOptions(*options.as_tuple())  # copy in case user changes options
+        num_questions = self.refill_size(options, num_buffered)
+
+        def refill():
+            # type: () -> None
+            start = time.time()
+            self.db.download_questions(options, num_questions)
+            refill_time = time.time() - start
+            with self._lock:
+                state = self._state(options, time.time())
+                state.refill_time = (state.refill_time + refill_time) / 2
+
+        return self.db.run_in_background(refill, name='download_questions',
+                                         key=('download_questions', options.as_tuple()))
+
+    def buffer(self, user_id, question_ids):
+        # type: (int, intbitset) -> None
+        """Record the next `question_ids` user `user_id` will be served, in order."""
+        buffered = intbitset(list(islice(question_ids, self.high_watermark)))
+        with self._lock:
+            self._buffers[user_id] = (time.time(), buffered)
+
+    def buffered_question_ids(self):
+        # type: () -> intbitset
+        """Get the ids of the questions buffered for all recently active users."""
+        now = time.time()
+        buffered = intbitset()
+        with self._lock:
+            for user_id, (buffered_time, question_ids) in self._buffers.items():
+                if now - buffered_time < QuestionPrefetcher.ACTIVE_TIME:
+                    buffered |= question_ids
+                else:
+                    del self._buffers[user_id]
+        return buffered
+
+    def clear(self):
+        # type: () -> None
+        """Forget all serving rates and buffered questions, e.g. after the DB was cleared."""
+        with self._lock:
+            self._states.clear()
+            self._buffers.clear()
@@ -0,0 +1,79 @@
+import itertools
+import threading
+from collections import defaultdict
+from intbitset import intbitset
+
+from typing import Dict, Iterable, Tuple
+
+from core import question_options
+from core.question_options import QuestionOptions
+from core.questions import Question
+
+IndexKey = Tuple[str, str, int]
+
+
+class QuestionIndex(object):
+    """
+    In-memory inverted index from (type, difficulty, category id) to the ids of matching questions.
+
+    Every question is indexed under all 8 combinations of its values and None (meaning any value),
+    so looking up the questions matching any `QuestionOptions` is a single dict lookup.
+    """
+
+    def __init__(self):
+        # type: () -> None
+        self._index = defaultdict(intbitset)  # type: Dict[IndexKey, intbitset]
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_bitsets(cls, bitsets):
+        # type: (Dict[IndexKey, intbitset]) -> QuestionIndex
+        """Create an index from the ids of each key, as returned by `bitsets()`."""
+        index = cls()
+        index._index.update(bitsets)
+        return index
+
+    def __len__(self):
+        # type: () -> int
+        """Number of indexed questions."""
+        return len(self._index.get((None, None, None), ()))
+
+    @staticmethod
+    def _keys(type, difficulty, category):
+        # type: (unicode, unicode, unicode) -> Iterable[IndexKey]
+        category_id = question_options.categories.get(
+                question_options.normalize_category(category))  # type: int
+        return itertools.product((type, None), (difficulty, None), (category_id, None))
+
+    def add(self, question_id, type, difficulty, category):
+        # type: (int, unicode, unicode, unicode) -> None
+        """Index question with `question_id` and Open Trivia `type`, `difficulty`, `category`."""
+        with self._lock:
+            for key in self._keys(type, difficulty, category):
+                self._index[key].add(question_id)
+
+    def add_all(self, rows):
+        # type: (Iterable[Tuple[int, unicode, unicode, unicode]]) -> None
+        """Index (id, type, difficulty, category) `rows`."""
+        for row in rows:
+            self.add(*row)
+
+    def add_question(self, question):
+        # type: (Question) -> None
+        self.add(question.id, question.type, question.difficulty, question.category)
+
+    def get(self, options):
+        # type: (QuestionOptions) -> intbitset
+        """Get the ids of all questions matching `options`.  Don't mutate the result."""
+        return self._index.get(options.api_values(), intbitset())
+
+    def ids(self):
+        # type: () -> intbitset
+        """Get the ids of all indexed questions.  Don't mutate the result."""
+        return self._index.get((None, None, None), intbitset())
+
+    def bitsets(self):
+        # type: () -> Dict[IndexKey, intbitset]
+        """Get a copy of the ids of each key."""
+        with self._lock:
+            return {key: ids.copy() for key, ids in self._index.viewitems()}
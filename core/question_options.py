@@ -53,6 +53,12 @@ class InvalidQuestionOptionException(Exception):
     pass
 
 
+def normalize_category(category):
+    # type: (unicode) -> unicode
+    """Convert an Open Trivia category name (e.g. 'Entertainment: Books') to a `categories` key."""
+    return category.replace(': ', ', ')
+
+
 @register_namedtuple
 class QuestionOptions(Tupleable):
     """
@@ -110,6 +116,15 @@ class QuestionOptions(Tupleable):
                 value = None
             self.__dict__[field] = value
     
+    def api_values(self):
+        # type: () -> Tuple[str, str, int]
+        """
+        Get the Open Trivia (type, difficulty, category id) values of these options,
+        where None means any value.
+        """
+        return tuple(converter.get(self.__dict__[field], None) or None
+                     for field, converter in fields.viewitems())
+    
     def _yield_query_string(self):
         # type: () -> Iterable[str]
         """
@@ -1,9 +1,10 @@
+import hashlib
 import random
 
 import simplejson as json
 from typing import Any, Dict, Iterable, List, Tuple
 
-from api import trivia
+from api import audio_formats, trivia
 from api.text_to_speech import AudioDownloader
 from core.question_options import QuestionOptions
 from util import io
@@ -45,6 +46,8 @@ class Question(Tupleable, AudioDownloader):
     :type audio_path str
     """
     
+    AUDIO_ENCODING = audio_formats.QUESTION_ENCODING  # type: str
+    
     def __init__(self, id, question, answer, choices, type, difficulty, category, audio_path=None):
         # type: (int, unicode, unicode, Tuple[unicode], unicode, unicode, unicode, str) -> None
         super(Question, self).__init__(audio_path)
@@ -103,8 +106,23 @@ class Question(Tupleable, AudioDownloader):
     def text(self):
         # type: () -> unicode
         """Convert entire question to text Watson will read."""
+        # choices are reshuffled every time a question is loaded anyway,
+        # so read them in a canonical order to make the same question's audio cacheable
         return u'The question is: {}.  The choices are: {}.  Select the correct answer.' \
-            .format(self.question, u', '.join(self.choices))
+            .format(self.question, u', '.join(sorted(self.choices)))
+    
+    def content_key(self):
+        # type: () -> str
+        """
+        Hash the question's content: question, answer, and sorted choices.
+        Unlike `hash()`, this doesn't depend on the id, audio, or shuffled order of the choices.
+        """
+        choices = self.choices
+        if isinstance(choices, basestring):
+            # already serialized
+            choices = json.loads(choices)
+        content = [self.question, self.answer, sorted(choices)]
+        return hashlib.sha1(json.dumps(content)).hexdigest()
     
     def serialize_choices(self):
         # type: () -> Question
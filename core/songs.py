@@ -1,6 +1,6 @@
 from typing import Any, Iterable, Tuple
 
-from api import music
+from api import audio_formats, music
 from api.text_to_speech import AudioDownloader
 from util import io
 from util.annotations import override
@@ -30,6 +30,10 @@ class Song(Tupleable, AudioDownloader):
     :type audio_path str
     """
     
+    AUDIO_ENCODING = audio_formats.SONG_ENCODING  # type: str
+    # lyrics are long, so synthesize them in parallel chunks
+    SYNTHESIS_CHUNK_SIZE = 500  # type: int
+    
     def __init__(self, id, artist, name, lyrics, audio_path=None):
         # type: (int, unicode, unicode, unicode, str) -> None
         super(Song, self).__init__(audio_path)
@@ -48,11 +52,10 @@ class Song(Tupleable, AudioDownloader):
         return self.id, self.artist, self.name, self.lyrics, self.audio_path
     
     @classmethod
-    def get_song(cls, song_num, dir_path):
-        # type: (int, str) -> Song
-        """Get `song_num`th song in the Musixmatch rankings."""
-        id, artist, name, lyrics = music.get_song(song_num)
-        song = cls(id, artist, name, lyrics)
+    def from_chart(cls, id, artist, name, dir_path):
+        # type: (int, unicode, unicode, str) -> Song
+        """Get song from a Musixmatch chart entry, downloading its lyrics and audio."""
+        song = cls(id, artist, name, music.get_lyrics(id))
         song.download_audio(dir_path)
         return song
     
@@ -1,5 +1,7 @@
+import base64
 from intbitset import intbitset
 
+import simplejson as json
 from typing import Any, Dict, Iterable, Tuple
 
 from core.question_options import QuestionOptions
@@ -114,6 +116,27 @@ class User(Tupleable):
         # type: () -> buffer
         return self._serialize_intbitset(self.songs)
     
+    def serialize(self):
+        # type: () -> str
+        """Serialize all fields compactly, e.g. for a shared session store."""
+        return json.dumps([
+            self.id, self.username, self.points,
+            base64.b64encode(self.questions.fastdump()), base64.b64encode(self.songs.fastdump()),
+            self.last_question_id, self.starting_points, self.winning_points,
+            self.options.as_tuple(),
+        ], separators=(',', ':'))
+    
+    @classmethod
+    def deserialize(cls, serialized):
+        # type: (str) -> User
+        """Deserialize a `User` serialized by `serialize()`."""
+        id, username, points, questions, songs, last_question_id, starting_points, \
+            winning_points, options = json.loads(serialized)
+        return cls(id, username, points,
+                   cls._deserialize_intbitset(base64.b64decode(questions)),
+                   cls._deserialize_intbitset(base64.b64decode(songs)),
+                   last_question_id, starting_points, winning_points, QuestionOptions(*options))
+    
     def complete_question(self, question):
         # type: (Question) -> None
         """Complete `question` for self, incrementing points and questions."""
@@ -0,0 +1,26 @@
+# gunicorn -c gunicorn.conf.py wsgi:app
+
+import multiprocessing
+
+bind = '127.0.0.1:8000'
+workers = multiprocessing.cpu_count() * 2 + 1
+# several threads per worker, since requests mostly wait on APIs and audio synthesis
+worker_class = 'gthread'
+threads = 4
+# import the app once in the master, shared copy-on-write by the workers
+preload_app = True
+
+
+def on_starting(server):
+    from core import app
+    app.check_num_workers(server.cfg.workers)
+
+
+def when_ready(server):
+    from core import app
+    app.preload()
+
+
+def post_fork(server, worker):
+    from core import app
+    app.post_fork(server.cfg.workers)
@@ -0,0 +1,129 @@
+"""
+Report where a fresh worker's startup time goes:
+the import time of each module, then the time of each init step up to serving /welcome.
+
+    $ python profile_startup.py [--limit 25] [--sort self|total] [--index]
+"""
+
+from __future__ import print_function
+
+import __builtin__
+import argparse
+import sys
+import time
+from contextlib import contextmanager
+
+from typing import Callable, Iterator, List, Tuple
+
+
+class ImportTimer(object):
+    """
+    Times the first import of every module while installed as `__import__`.
+
+    :ivar times: (module name, total seconds, self seconds excluding nested imports)
+    :type times: list[(str, float, float)]
+    """
+
+    def __init__(self):
+        # type: () -> None
+        self.times = []  # type: List[Tuple[str, float, float]]
+        # seconds spent in nested imports of each import in progress
+        self._nested = []  # type: List[float]
+        self._import = None  # type: Callable
+
+    def __enter__(self):
+        # type: () -> ImportTimer
+        self._import = __builtin__.__import__
+        __builtin__.__import__ = self._timed_import
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # type: (type, BaseException, object) -> None
+        __builtin__.__import__ = self._import
+
+    @staticmethod
+    def _module_name(name, globals, level):
+        # type: (str, dict, int) -> str
+        """Get the absolute name of the module imported as `name` by the module with `globals`."""
+        if level == 0 or not globals or '__name__' not in globals:
+            return name
+        package = globals.get('__package__')
+        if not package:
+            module_name = globals['__name__']  # type: str
+            package = module_name if '__path__' in globals else module_name.rpartition('.')[0]
+        if level > 0:
+            package = package.rsplit('.', level - 1)[0]
+            return package + '.' + name if name else package
+        # implicit relative import
+        relative_name = package + '.' + name if package else name
+        # failed implicit relative imports leave None in sys.modules
+        return relative_name if sys.modules.get(relative_name) is not None else name
+
+    def _timed_import(self, name, globals=None, locals=None, fromlist=None, level=-1):
+        num_modules = len(sys.modules)
+        self._nested.append(0.0)
+        start = time.time()
+        try:
+            return self._import(name, globals, locals, fromlist, level)
+        finally:
+            total = time.time() - start
+            nested = self._nested.pop()
+            if self._nested:
+                self._nested[-1] += total
+            if len(sys.modules) > num_modules:
+                module_name = ImportTimer._module_name(name, globals, level)
+                # submodules imported by `from package import module` are timed with the package
+                submodules = [module_name + '.' + item for item in fromlist or ()
+                              if module_name + '.' + item in sys.modules]
+                self.times.append((', '.join([module_name] + submodules), total, total - nested))
+
+
+@contextmanager
+def timed(step, times):
+    # type: (str, List[Tuple[str, float]]) -> Iterator[None]
+    start = time.time()
+    yield
+    times.append((step, time.time() - start))
+
+
+def main():
+    # type: () -> None
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--limit', type=int, default=25, help='number of modules to report')
+    parser.add_argument('--sort', choices=['self', 'total'], default='self')
+    parser.add_argument('--index', action='store_true',
+                        help='also load the question index, as preload() does before forking')
+    args = parser.parse_args()
+
+    steps = []  # type: List[Tuple[str, float]]
+    with ImportTimer() as import_timer:
+        with timed('import core.app', steps):
+            from core import app
+    from util import lazy
+
+    with timed('configure_app()', steps):
+        flask_app = app.configure_app()
+    with timed('open DB', steps):
+        db = lazy.resolve(app.db)
+    if args.index:
+        with timed('load question index', steps):
+            db.in_memory_indices()
+    client = flask_app.test_client()
+    with timed('first GET /welcome', steps):
+        client.get('/welcome')
+    with timed('second GET /welcome', steps):
+        client.get('/welcome')
+
+    key = 2 if args.sort == 'self' else 1
+    print('{:>9} {:>9}  module'.format('self ms', 'total ms'))
+    for name, total, self_time in sorted(import_timer.times, key=lambda t: -t[key])[:args.limit]:
+        print('{:9.1f} {:9.1f}  {}'.format(self_time * 1000, total * 1000, name))
+    print()
+    for step, seconds in steps:
+        print('{:9.1f}  {}'.format(seconds * 1000, step))
+    print('{:9.1f}  total'.format(sum(seconds for step, seconds in steps) * 1000))
+    db.close()
+
+
+if __name__ == '__main__':
+    main()
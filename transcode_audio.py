@@ -0,0 +1,101 @@
+"""
+One-off migration re-encoding existing wav audio into compressed formats
+and updating audio_path in the questions and songs tables.
+
+Requires ffmpeg (with libopus and libmp3lame) on the PATH.
+
+    $ python transcode_audio.py [--db data/listen_up.db] [--jobs 4] [--keep]
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import subprocess
+from sys import stderr
+
+from typing import List, Tuple, Union
+
+from api import audio_formats
+from util import io
+from util.concurrency import parallel_map
+from util.db.db import Database
+
+# ffmpeg output options by file extension
+ffmpeg_args = {
+    'ogg': ['-c:a', 'libopus', '-b:a', '32k'],
+    'mp3': ['-c:a', 'libmp3lame', '-q:a', '5'],
+    'flac': ['-c:a', 'flac'],
+}
+
+
+def transcode(path, encoding):
+    # type: (str, str) -> str
+    """Re-encode the audio file at `path` as `encoding` and return the new path."""
+    new_path = os.path.splitext(path)[0] + '.' + encoding
+    with open(os.devnull, 'w') as devnull:
+        subprocess.check_call(['ffmpeg', '-y', '-loglevel', 'error', '-i', path]
+                              + ffmpeg_args[encoding] + [new_path],
+                              stdout=devnull)
+    return new_path
+
+
+def transcode_table(db, table, encoding, jobs, keep):
+    # type: (Database, str, str, int, bool) -> int
+    """
+    Re-encode all wav audio of `table` as `encoding` and return the number re-encoded.
+    Files ffmpeg fails on, e.g. empty ones, are reported and keep their wav audio.
+    """
+    with db:
+        rows = db.cursor.execute(
+                'SELECT id, audio_path FROM {} WHERE audio_path LIKE ?'.format(table),
+                ['%.wav']).fetchall()  # type: List[Tuple[int, str]]
+    rows = [(id, path) for id, path in rows if os.path.exists(path)]
+
+    def transcode_row(row):
+        # type: (Tuple[int, str]) -> Union[Tuple[int, str, str], None]
+        id, path = row
+        try:
+            new_path = transcode(path, encoding)
+        except subprocess.CalledProcessError as e:
+            print('failed to re-encode {}: {}'.format(path, e), file=stderr)
+            io.remove_if_exists(os.path.splitext(path)[0] + '.' + encoding)
+            return None
+        print('{} -> {}'.format(path, new_path))
+        return id, path, new_path
+
+    transcoded = [result for result in parallel_map(transcode_row, rows, jobs)
+                  if result is not None]  # type: List[Tuple[int, str, str]]
+    with db.writing():
+        db.cursor.executemany('UPDATE {} SET audio_path = ? WHERE id = ?'.format(table),
+                              [(new_path, id) for id, path, new_path in transcoded])
+    if not keep:
+        for id, path, new_path in transcoded:
+            io.remove_if_exists(path)
+    return len(transcoded)
+
+
+def main():
+    # type: () -> None
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--db', default='data/listen_up.db')
+    parser.add_argument('--questions-encoding', default=audio_formats.QUESTION_ENCODING,
+                        choices=sorted(ffmpeg_args))
+    parser.add_argument('--songs-encoding', default=audio_formats.SONG_ENCODING,
+                        choices=sorted(ffmpeg_args))
+    parser.add_argument('--jobs', type=int, default=4)
+    parser.add_argument('--keep', action='store_true', help='keep the original wav files')
+    args = parser.parse_args()
+
+    db = Database(args.db)
+    try:
+        for table, encoding in (('questions', args.questions_encoding),
+                                ('songs', args.songs_encoding)):
+            num_transcoded = transcode_table(db, table, encoding, args.jobs, args.keep)
+            print('re-encoded {} {} as {}'.format(num_transcoded, table, encoding), file=stderr)
+    finally:
+        db.close()
+
+
+if __name__ == '__main__':
+    main()
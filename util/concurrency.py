@@ -0,0 +1,95 @@
+import sys
+import threading
+from Queue import Queue
+from threading import Thread
+
+from typing import Callable, ContextManager, Dict, Iterable, List, Type
+
+T = Type['T']
+R = Type['R']
+
+# functions capturing state of the calling thread, each returning a function
+# that creates a context manager restoring that state in a worker thread
+_thread_state_capturers = []  # type: List[Callable[[], Callable[[], ContextManager]]]
+
+
+def inherit_thread_state(capture):
+    # type: (Callable[[], Callable[[], ContextManager]]) -> None
+    """
+    Make `parallel_map()` workers inherit thread-local state of its caller:
+    `capture()` is called on the calling thread, and the context manager its result creates
+    is entered by each worker thread around all its calls.
+    """
+    _thread_state_capturers.append(capture)
+
+
+def parallel_map(function, iterable, parallelism, max_pending=None):
+    # type: (Callable[[T], R], Iterable[T], int, int) -> List[R]
+    """
+    Apply `function` to every item of `iterable` on `parallelism` threads
+    and return the results in order.
+
+    `iterable` is consumed lazily by the calling thread through a queue of at most `max_pending`
+    items (defaults to 2 * `parallelism`), so a slow `function` applies backpressure to it.
+    If `function` raises, no more items are consumed and the first exception is re-raised.
+    Workers inherit the caller's thread-local state registered with `inherit_thread_state()`.
+    """
+    if parallelism <= 1:
+        return map(function, iterable)
+    if max_pending is None:
+        max_pending = 2 * parallelism
+
+    pending = Queue(max_pending)  # type: Queue
+    results = {}  # type: Dict[int, R]
+    errors = []  # type: List[tuple]
+    failed = threading.Event()
+    inherited_states = [capture() for capture in _thread_state_capturers]
+
+    def work():
+        # type: () -> None
+        contexts = [inherited_state() for inherited_state in inherited_states]
+        for context in contexts:
+            context.__enter__()
+        try:
+            work_inherited()
+        finally:
+            for context in reversed(contexts):
+                context.__exit__(None, None, None)
+
+    def work_inherited():
+        # type: () -> None
+        while True:
+            job = pending.get()
+            if job is None:
+                return
+            i, item = job
+            if failed.is_set():
+                continue
+            try:
+                results[i] = function(item)
+            except:
+                errors.append(sys.exc_info())
+                failed.set()
+
+    workers = [Thread(target=work, name='parallel_map-{}'.format(i)) for i in xrange(parallelism)]
+    for worker in workers:
+        worker.daemon = True
+        worker.start()
+
+    num_items = 0
+    try:
+        for item in iterable:
+            if failed.is_set():
+                break
+            pending.put((num_items, item))
+            num_items += 1
+    finally:
+        for _ in workers:
+            pending.put(None)
+        for worker in workers:
+            worker.join()
+
+    if errors:
+        exc_type, exc_value, traceback = errors[0]
+        raise exc_type, exc_value, traceback
+    return [results[i] for i in xrange(num_items)]
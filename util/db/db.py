@@ -1,25 +1,285 @@
 import functools
 import sqlite3
+import sys
 import threading
-from threading import Thread
+from collections import deque
+from contextlib import contextmanager
 
-from typing import Callable, Dict, Union
+from typing import Callable, ContextManager, Dict, Hashable, Iterable, Iterator, Union
 
+from util.jobs import JobExecutor
 from util.types import Function
 
 
+class ConnectionPool(object):
+    """
+    Bounded pool of SQLite connections.
+    
+    Each connection is checked out by at most one thread at a time,
+    so connections never need to be shared between concurrently running threads.
+    
+    :ivar path: path of the SQLite DB
+    :type path: str
+    
+    :ivar max_size: max number of open connections (idle + checked out)
+    :type max_size: int
+    
+    :ivar timeout: seconds a connection waits on a locked DB before raising
+    :type timeout: float
+    
+    :ivar configure: called on every newly opened connection, e.g. to set PRAGMAs
+    :type configure: Callable[[sqlite3.Connection], None]
+    """
+    
+    DEFAULT_MAX_SIZE = 8  # type: int
+    DEFAULT_TIMEOUT = 5.0  # type: float
+    
+    def __init__(self, path, max_size=DEFAULT_MAX_SIZE, timeout=DEFAULT_TIMEOUT, configure=None):
+        # type: (str, int, float, Callable[[sqlite3.Connection], None]) -> None
+        self.path = path
+        self.max_size = max_size
+        self.timeout = timeout
+        self.configure = configure
+        self._idle = deque()  # type: deque
+        self._size = 0  # type: int
+        self._condition = threading.Condition()
+        self._closed = False
+    
+    def _connect(self):
+        # type: () -> sqlite3.Connection
+        # connections are handed from thread to thread by the pool,
+        # but are never used by two threads at once
+        conn = sqlite3.connect(self.path, timeout=self.timeout, check_same_thread=False)
+        if self.configure is not None:
+            self.configure(conn)
+        return conn
+    
+    @staticmethod
+    def _is_healthy(conn):
+        # type: (sqlite3.Connection) -> bool
+        try:
+            conn.execute('SELECT 1').fetchone()
+        except sqlite3.Error:
+            return False
+        return True
+    
+    @staticmethod
+    def _close_quietly(conn):
+        # type: (sqlite3.Connection) -> None
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+    
+    def acquire(self):
+        # type: () -> sqlite3.Connection
+        """Check out an idle connection, opening a new one if the pool isn't full yet."""
+        conn = None
+        with self._condition:
+            while True:
+                if self._closed:
+                    raise sqlite3.ProgrammingError('connection pool for {} is closed'
+                                                   .format(self.path))
+                if self._idle:
+                    conn = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    self._size += 1
+                    break
+                self._condition.wait()
+        
+        if conn is not None:
+            if self._is_healthy(conn):
+                return conn
+            # recycle broken connection, keeping its slot
+            self._close_quietly(conn)
+        try:
+            return self._connect()
+        except:
+            self._free_slot()
+            raise
+    
+    def _free_slot(self):
+        # type: () -> None
+        with self._condition:
+            self._size -= 1
+            self._condition.notify()
+    
+    def release(self, conn):
+        # type: (sqlite3.Connection) -> None
+        """Return a checked out connection to the pool, rolling back anything uncommitted."""
+        try:
+            conn.rollback()
+        except sqlite3.Error:
+            self.discard(conn)
+            return
+        with self._condition:
+            if not self._closed:
+                self._idle.append(conn)
+                self._condition.notify()
+                return
+        self.discard(conn)
+    
+    def discard(self, conn):
+        # type: (sqlite3.Connection) -> None
+        """Close a checked out connection instead of returning it, e.g. after an error."""
+        self._close_quietly(conn)
+        self._free_slot()
+    
+    def close(self):
+        # type: () -> None
+        """Close all idle connections.  Checked out connections are closed when released."""
+        with self._condition:
+            self._closed = True
+            idle = list(self._idle)
+            self._idle.clear()
+            self._size -= len(idle)
+            self._condition.notify_all()
+        for conn in idle:
+            self._close_quietly(conn)
+
+
+class JournalConfig(object):
+    """
+    SQLite journaling configuration.
+    
+    :ivar journal_mode: 'wal' lets readers run concurrently with the single writer,
+        'delete' is SQLite's default rollback journal
+    :type journal_mode: str
+    
+    :ivar synchronous: 'off', 'normal', 'full' or 'extra';
+        'normal' is durable enough in WAL mode and skips most fsyncs
+    :type synchronous: str
+    
+    :ivar busy_timeout: milliseconds a connection waits on a locked DB before raising
+    :type busy_timeout: int
+    
+    :ivar wal_autocheckpoint: WAL size in pages that triggers SQLite's automatic checkpoint,
+        0 to disable it
+    :type wal_autocheckpoint: int
+    
+    :ivar checkpoint_mode: 'passive', 'full', 'restart' or 'truncate',
+        used by `Database.checkpoint()`
+    :type checkpoint_mode: str
+    
+    :ivar checkpoint_interval: number of write commits between explicit checkpoints,
+        None to only rely on `wal_autocheckpoint`
+    :type checkpoint_interval: int
+    """
+    
+    def __init__(self, journal_mode='wal', synchronous='normal', busy_timeout=5000,
+                 wal_autocheckpoint=1000, checkpoint_mode='passive', checkpoint_interval=None):
+        # type: (str, str, int, int, str, int) -> None
+        self.journal_mode = journal_mode
+        self.synchronous = synchronous
+        self.busy_timeout = busy_timeout
+        self.wal_autocheckpoint = wal_autocheckpoint
+        self.checkpoint_mode = checkpoint_mode
+        self.checkpoint_interval = checkpoint_interval
+    
+    def is_wal(self):
+        # type: () -> bool
+        return self.journal_mode.lower() == 'wal'
+    
+    def configure(self, conn):
+        # type: (sqlite3.Connection) -> None
+        """Set the per-connection PRAGMAs."""
+        conn.execute('PRAGMA synchronous = {}'.format(self.synchronous.upper()))
+        conn.execute('PRAGMA busy_timeout = {:d}'.format(self.busy_timeout))
+    
+    def configure_reader(self, conn):
+        # type: (sqlite3.Connection) -> None
+        self.configure(conn)
+        conn.execute('PRAGMA query_only = ON')
+    
+    def configure_writer(self, conn):
+        # type: (sqlite3.Connection) -> None
+        self.configure(conn)
+        # journal_mode is persistent in the DB file, so setting it on the writer is enough
+        conn.execute('PRAGMA journal_mode = {}'.format(self.journal_mode.upper()))
+        if self.is_wal():
+            conn.execute('PRAGMA wal_autocheckpoint = {:d}'.format(self.wal_autocheckpoint))
+
+
 class Database(object):
-    """Database wrapper."""
+    """
+    Database wrapper.
     
-    def __init__(self, path, debug=False):
-        # type: (str) -> None
+    Reads go through reader connections from a `ConnectionPool`, one per thread,
+    so reads from different threads run concurrently.
+    Writes go through `writing()`, which serializes them on a single writer connection.
+    With a WAL `JournalConfig`, readers never wait on the writer.
+    """
+    
+    def __init__(self, path, debug=False, pool_size=ConnectionPool.DEFAULT_MAX_SIZE,
+                 journal=None):
+        # type: (str, bool, int, JournalConfig) -> None
+        if journal is None:
+            journal = JournalConfig()
         self.path = path
-        self.conn = sqlite3.connect(path, check_same_thread=False)
-        # multithreading is only safe when Database.lock() is used
-        self.cursor = self.conn.cursor()
-        self._lock = threading.Lock()
+        self.journal = journal
+        self._local = threading.local()
+        self._write_lock = threading.RLock()
+        self._writer = None  # type: sqlite3.Connection
+        self._writer_cursor = None  # type: sqlite3.Cursor
+        self._commits_since_checkpoint = 0
+        # open the writer first so the journal mode is set before any reader connects
+        with self._write_lock:
+            self._get_writer()
+        self.pool = ConnectionPool(path, pool_size, journal.busy_timeout / 1000.0,
+                                   journal.configure_reader)
         self.debug = debug
     
+    def _get_writer(self):
+        # type: () -> sqlite3.Connection
+        """Get the writer connection, (re)opening it if needed.  Must hold the write lock."""
+        if self._writer is None:
+            # transactions are begun explicitly by writing()
+            conn = sqlite3.connect(self.path, timeout=self.journal.busy_timeout / 1000.0,
+                                   check_same_thread=False, isolation_level=None)
+            self.journal.configure_writer(conn)
+            self._writer = conn
+            self._writer_cursor = conn.cursor()
+        return self._writer
+    
+    def _discard_writer(self):
+        # type: () -> None
+        """Close the writer connection so it's reopened on the next write."""
+        if self._writer is not None:
+            ConnectionPool._close_quietly(self._writer)
+        self._writer = None
+        self._writer_cursor = None
+    
+    def _is_writing(self):
+        # type: () -> bool
+        return getattr(self._local, 'write_depth', 0) > 0
+    
+    def _state(self):
+        # type: () -> threading.local
+        """Get this thread's reader connection state, checking out a connection if it has none."""
+        local = self._local
+        if getattr(local, 'conn', None) is None:
+            local.conn = self.pool.acquire()
+            local.cursor = local.conn.cursor()
+            local.depth = 0
+        return local
+    
+    @property
+    def conn(self):
+        # type: () -> sqlite3.Connection
+        """The writer connection inside `writing()`, otherwise this thread's reader connection."""
+        if self._is_writing():
+            return self._writer
+        return self._state().conn
+    
+    @property
+    def cursor(self):
+        # type: () -> sqlite3.Cursor
+        """The writer cursor inside `writing()`, otherwise this thread's reader cursor."""
+        if self._is_writing():
+            return self._writer_cursor
+        return self._state().cursor
+    
     @staticmethod
     def sanitize(s):
         # type: (str) -> str
@@ -35,6 +295,11 @@ class Database(object):
         query = 'SELECT COUNT(*) FROM sqlite_master WHERE type="table" AND name=?'
         return self.cursor.execute(query, [Database.desanitize(table_name)]).fetchone()[0] > 0
     
+    def column_exists(self, table_name, column_name):
+        # type: (str, str) -> bool
+        query = 'PRAGMA table_info({})'.format(table_name)
+        return any(column[1] == column_name for column in self.cursor.execute(query).fetchall())
+    
     def result_exists(self):
         return self.cursor.fetchone() is not None
     
@@ -47,22 +312,70 @@ class Database(object):
         # type: () -> None
         self.conn.commit()
     
+    def checkpoint(self, mode=None):
+        # type: (str) -> None
+        """Checkpoint the WAL into the DB file using `mode` or the configured checkpoint mode."""
+        if not self.journal.is_wal():
+            return
+        if mode is None:
+            mode = self.journal.checkpoint_mode
+        with self._write_lock:
+            self._get_writer().execute('PRAGMA wal_checkpoint({})'.format(mode.upper()))
+            self._commits_since_checkpoint = 0
+    
+    def _after_commit(self):
+        # type: () -> None
+        """Run the checkpoint policy after a write commit.  Must hold the write lock."""
+        interval = self.journal.checkpoint_interval
+        if interval is None:
+            return
+        self._commits_since_checkpoint += 1
+        if self._commits_since_checkpoint >= interval:
+            self.checkpoint()
+    
     def hard_close(self):
         # type: () -> None
-        self.conn.close()
+        self.pool.close()
+        with self._write_lock:
+            self._discard_writer()
     
     def close(self):
         # type: () -> None
-        self.commit()
+        with self._write_lock:
+            if self._writer is not None:
+                self._writer.commit()
+        self._release(force=True)
         self.hard_close()
     
     def lock(self):
         # type: () -> None
-        self._lock.acquire()
+        """Check out this thread's reader connection until the matching `release_lock()`."""
+        self._state().depth += 1
     
     def release_lock(self):
         # type: () -> None
-        self._lock.release()
+        self._release()
+    
+    def _release(self, broken=False, force=False):
+        # type: (bool, bool) -> None
+        """
+        Return this thread's reader connection to the pool once it's no longer locked,
+        discarding it instead if it's `broken`.
+        """
+        local = self._local
+        conn = getattr(local, 'conn', None)
+        if conn is None:
+            return
+        if not force:
+            local.depth -= 1
+            if local.depth > 0:
+                return
+        local.conn = None
+        local.cursor = None
+        if broken:
+            self.pool.discard(conn)
+        else:
+            self.pool.release(conn)
     
     def __enter__(self):
         # type: () -> Database
@@ -71,11 +384,62 @@ class Database(object):
     
     def __exit__(self, exc_type, exc_value, traceback):
         # type: () -> None
-        self.release_lock()
+        self._release(broken=Database._is_connection_error(exc_type))
+    
+    @staticmethod
+    def _is_connection_error(exc_type):
+        # type: (type) -> bool
+        """Check if an exception means the connection itself may be unusable."""
+        return exc_type is not None \
+               and issubclass(exc_type, sqlite3.Error) \
+               and not issubclass(exc_type, sqlite3.IntegrityError)
+    
+    def reading(self):
+        # type: () -> ContextManager[Database]
+        """
+        Run the with block on this thread's reader connection.
+        Readers never take the write lock.
+        Inside `writing()`, reads stay on the writer so they see uncommitted writes.
+        """
+        return self
+    
+    @contextmanager
+    def writing(self):
+        # type: () -> Iterator[Database]
+        """
+        Run the with block on the single writer connection.
+        Writers are serialized, and the outermost block commits on success or rolls back on error.
+        The outermost block takes SQLite's write lock up front (BEGIN IMMEDIATE),
+        so its reads are serialized with writes of other processes too.
+        """
+        with self._write_lock:
+            local = self._local
+            local.write_depth = getattr(local, 'write_depth', 0) + 1
+            outermost = local.write_depth == 1
+            try:
+                writer = self._get_writer()
+                if outermost:
+                    writer.execute('BEGIN IMMEDIATE')
+                yield self
+                if outermost:
+                    self._writer.commit()
+                    self._after_commit()
+            except:
+                if outermost and self._writer is not None:
+                    if Database._is_connection_error(sys.exc_info()[0]):
+                        self._discard_writer()
+                    else:
+                        self._writer.rollback()
+                raise
+            finally:
+                local.write_depth -= 1
     
     def reset_connection(self):
-        self.conn = sqlite3.connect(self.path)
-        self.cursor = self.conn.cursor()
+        # type: () -> None
+        """Replace this thread's reader connection with a fresh one."""
+        depth = self._state().depth
+        self._release(broken=True, force=True)
+        self._state().depth = depth
 
 
 class ApplicationDatabaseException(Exception):
@@ -96,17 +460,33 @@ class ApplicationDatabase(object):
     :ivar schema: SQl DB schema
     :type schema: Dict[str, str]
     
+    :ivar indices: SQL CREATE INDEX statements, run after the tables are created
+    :type indices: List[str]
+    
     :ivar exception: Exception class used by DB
     :type exception: type(ApplicationDatabaseException)
+    
+    :ivar executor: runs background jobs
+    :type executor: JobExecutor
     """
     
-    def __init__(self, schema, path, exception=ApplicationDatabaseException):
-        # type: (Dict[str, str], Union[str, unicode], type(ApplicationDatabaseException)) -> None
-        """Create DB with given name and open low level connection through `Database`"""
+    def __init__(self, schema, path, exception=ApplicationDatabaseException,
+                 pool_size=ConnectionPool.DEFAULT_MAX_SIZE, journal=None,
+                 background_workers=JobExecutor.DEFAULT_NUM_WORKERS,
+                 background_queue_size=JobExecutor.DEFAULT_MAX_QUEUE_SIZE, indices=()):
+        # type: (Dict[str, str], Union[str, unicode], type(ApplicationDatabaseException), int, JournalConfig, int, int, Iterable[str]) -> None
+        """
+        Create DB with given name and open low level connections through `Database`.
+        `journal` defaults to WAL mode (see `JournalConfig`).
+        Background jobs run on a bounded `JobExecutor`.
+        """
         self.name = path
         self.schema = schema
+        self.indices = list(indices)
         self.exception = exception  # type:
-        self.db = Database(path)
+        self.db = Database(path, pool_size=pool_size, journal=journal)
+        self.executor = JobExecutor(background_workers, background_queue_size,
+                                    name=type(self).__name__)
         self._create_tables()
     
     def commit(self):
@@ -121,68 +501,96 @@ class ApplicationDatabase(object):
     
     def close(self):
         # type: () -> None
-        """Close and commit DB."""
-        self.commit()
-        self.db.hard_close()
+        """Finish running background jobs, dropping queued ones, then close and commit DB."""
+        self.executor.shutdown()
+        # commits the writer and returns this thread's reader, rather than checking one out
+        self.db.close()
     
     def lock(self):
         # type: () -> None
-        """Acquire reentrant lock. By locking, multithreaded to DB is safe."""
+        """Check out this thread's pooled connection (reentrant)."""
         self.db.lock()
     
     def release_lock(self):
         # type: () -> None
-        """Release reentrant lock."""
+        """Return this thread's connection to the pool once no longer locked."""
         self.db.release_lock()
     
+    def reading(self):
+        # type: () -> ContextManager[Database]
+        """Context manager for this thread's reader connection, which never waits on writes."""
+        return self.db.reading()
+    
+    def writing(self):
+        # type: () -> ContextManager[Database]
+        """Context manager for the single, serialized writer path.  Commits at the end."""
+        return self.db.writing()
+    
+    def checkpoint(self, mode=None):
+        # type: (str) -> None
+        """Checkpoint the WAL (see `JournalConfig`)."""
+        self.db.checkpoint(mode)
+    
     def __enter__(self):
         # type: () -> ApplicationDatabase
-        """Enter DB (lock) when entering with statement."""
+        """Enter DB (check out connection) when entering with statement."""
         self.db.__enter__()
         return self
     
     def __exit__(self, exc_type, exc_value, traceback):
         # type: () -> None
-        """Exit DB (release lock) after with statement."""
+        """Exit DB (return connection) after with statement."""
         self.db.__exit__(exc_type, exc_value, traceback)
     
     def _create_tables(self):
         # type: () -> None
-        """Create all tables according to `DB_SCHEMA`."""
-        map(self.db.cursor.execute, self.schema.viewvalues())
-        self.db.commit()
+        """Create all tables according to `DB_SCHEMA`, migrate them, and then create `indices`."""
+        with self.writing():
+            map(self.db.cursor.execute, self.schema.viewvalues())
+            self._migrate()
+            map(self.db.cursor.execute, self.indices)
+    
+    def _migrate(self):
+        # type: () -> None
+        """
+        Migrate tables created by an older `schema`, e.g. by adding new columns.
+        Runs on the writer path.  Intended to be overridden.
+        """
+        pass
     
     def clear(self):
         # type: () -> None
         """Drop and recreate tables."""
-        # noinspection SqlNoDataSourceInspection
-        self.db.cursor.executescript(
-                ''.join('DROP TABLE {};'.format(table) for table in self.schema))
-        self._create_tables()
-        self.commit()
+        with self.writing():
+            # noinspection SqlNoDataSourceInspection
+            self.db.cursor.executescript(
+                    ''.join('DROP TABLE {};'.format(table) for table in self.schema))
+            self._create_tables()
     
     def reset_connection(self):
         self.db.reset_connection()
     
-    def run_in_background(self, runnable, name=None):
-        # type: (Function, str) -> None
-        """Run `runnable` in another thread, locking on this DB."""
+    def run_in_background(self, runnable, name=None, key=None):
+        # type: (Function, str, Hashable) -> bool
+        """
+        Run `runnable` on a background worker with its own connection to this DB.
+        
+        Jobs are keyed by `key` (defaults to `name`), so a job whose key is already queued
+        or running is coalesced instead of queued again.
+        Return True if the job was queued (see `JobExecutor.submit()`).
+        """
         if name is None:
             name = runnable.func_name
         else:
             runnable.func_name = name
-        
-        print(threading.current_thread())
+        if key is None:
+            key = name
         
         @functools.wraps(runnable)
-        def locking_wrapper():
-            print('{} is waiting to run in the background'.format(name))
-            print(threading.current_thread())
+        def connecting_wrapper():
             with self:
                 print('{} is running in the background'.format(name))
                 runnable()
                 print('{} is done running in the background'.format(name))
         
-        thread = Thread(target=locking_wrapper)
-        thread.background = True
-        thread.start()
+        return self.executor.submit(key, connecting_wrapper)
@@ -0,0 +1,104 @@
+from __future__ import print_function
+
+import threading
+from collections import OrderedDict
+from sys import stderr
+from threading import Thread
+
+from typing import Any, Callable, Dict, Hashable, Iterable, List
+
+
+class WriteBehindBuffer(object):
+    """
+    Write-behind buffer that keeps the latest value for each dirty key in memory
+    and writes them all at once in a single batch,
+    either every `interval` seconds or as soon as `max_size` keys are dirty.
+
+    :ivar write_batch: writes a batch of values, e.g. in a single DB transaction
+    :type write_batch: Callable[[List[Any]], None]
+
+    :ivar interval: max seconds a dirty value waits before being written
+    :type interval: float
+
+    :ivar max_size: number of dirty keys that triggers an early write
+    :type max_size: int
+    """
+
+    DEFAULT_INTERVAL = 1.0  # type: float
+    DEFAULT_MAX_SIZE = 64  # type: int
+
+    def __init__(self, write_batch, interval=DEFAULT_INTERVAL, max_size=DEFAULT_MAX_SIZE,
+                 name='write_behind'):
+        # type: (Callable[[List[Any]], None], float, int, str) -> None
+        self.write_batch = write_batch
+        self.interval = interval
+        self.max_size = max_size
+        self._dirty = OrderedDict()  # type: Dict[Hashable, Any]
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._closed = False
+        self._thread = Thread(target=self._run, name=name)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __len__(self):
+        # type: () -> int
+        return len(self._dirty)
+
+    def put(self, key, value):
+        # type: (Hashable, Any) -> None
+        """Mark `key` dirty with its latest `value`."""
+        with self._lock:
+            self._dirty.pop(key, None)
+            self._dirty[key] = value
+            full = len(self._dirty) >= self.max_size
+        if full:
+            self._wakeup.set()
+
+    def get(self, key, default=None):
+        # type: (Hashable, Any) -> Any
+        """Get the not yet written value for `key`, or `default` if it isn't dirty."""
+        with self._lock:
+            return self._dirty.get(key, default)
+
+    def flush(self, keys=None):
+        # type: (Iterable[Hashable]) -> None
+        """Write all dirty values now, or only those for `keys`."""
+        with self._flush_lock:
+            with self._lock:
+                if keys is None:
+                    batch = self._dirty
+                    self._dirty = OrderedDict()
+                else:
+                    batch = OrderedDict((key, self._dirty.pop(key)) for key in keys
+                                        if key in self._dirty)
+            if not batch:
+                return
+            try:
+                self.write_batch(batch.values())
+            except:
+                # put back anything that wasn't dirtied again in the meantime
+                with self._lock:
+                    for key, value in batch.viewitems():
+                        self._dirty.setdefault(key, value)
+                raise
+
+    def _run(self):
+        # type: () -> None
+        while not self._closed:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                print('{} failed to flush: {}'.format(self._thread.name, e), file=stderr)
+
+    def close(self):
+        # type: () -> None
+        """Stop the background writer and write everything still dirty."""
+        self._closed = True
+        self._wakeup.set()
+        if self._thread is not threading.current_thread():
+            self._thread.join()
+        self.flush()
@@ -0,0 +1,74 @@
+import hashlib
+import os
+import threading
+
+from flask import Response, request, send_file
+from typing import Dict, Tuple
+
+# Cache-Control for URLs containing a digest of the content, which never change
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+SEND_MODES = ('sendfile', 'x-sendfile', 'x-accel-redirect')
+
+
+class FileDigests(object):
+    """Cache of content digests of files, recomputed when a file's size or mtime changes."""
+
+    def __init__(self):
+        # type: () -> None
+        self._digests = {}  # type: Dict[str, Tuple[float, int, str]]
+        self._lock = threading.Lock()
+
+    def digest(self, path):
+        # type: (str) -> str
+        """Get a short hex digest of the contents of the file at `path`."""
+        stat = os.stat(path)
+        with self._lock:
+            cached = self._digests.get(path)
+        if cached is not None and cached[:2] == (stat.st_mtime, stat.st_size):
+            return cached[2]
+        sha1 = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 16), b''):
+                sha1.update(block)
+        digest = sha1.hexdigest()[:16]
+        with self._lock:
+            self._digests[path] = (stat.st_mtime, stat.st_size, digest)
+        return digest
+
+    def forget(self, path):
+        # type: (str) -> None
+        with self._lock:
+            self._digests.pop(path, None)
+
+
+def send_immutable_file(path, digest, mimetype, mode='sendfile', accel_path=None):
+    # type: (str, str, str, str, str) -> Response
+    """
+    Send the file at `path` with `digest` as its ETag and immutable cache headers,
+    answering conditional and Range requests.
+
+    `mode` is one of `SEND_MODES`:
+        sendfile: serve the file from Python, using the WSGI server's zero-copy file wrapper
+        x-sendfile: let the front-end server send the file via an X-Sendfile header
+        x-accel-redirect: let nginx send the file via an X-Accel-Redirect to `accel_path`
+    """
+    if mode not in SEND_MODES:
+        raise ValueError('unknown send mode "{}"'.format(mode))
+    if mode == 'sendfile':
+        response = send_file(os.path.abspath(path), mimetype=mimetype,
+                             add_etags=False, conditional=False)
+        response.set_etag(digest)
+        response.make_conditional(request, accept_ranges=True,
+                                  complete_length=os.path.getsize(path))
+    else:
+        # the front-end server sends the file and handles Range requests itself
+        response = Response(mimetype=mimetype)
+        if mode == 'x-sendfile':
+            response.headers['X-Sendfile'] = os.path.abspath(path)
+        else:
+            response.headers['X-Accel-Redirect'] = accel_path
+        response.set_etag(digest)
+        response.make_conditional(request)
+    response.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+    return response
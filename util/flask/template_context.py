@@ -17,16 +17,6 @@ def _filter_hidden(dictionary):
     return {k: v for k, v in dictionary.viewitems() if not k.startswith('_')}
 
 
-def _filter_hidden_obj(obj):
-    return _filter_hidden({field: getattr(obj, field) for field in dir(obj)})
-
-
-# add non-hidden builtins
-context.update(_filter_hidden_obj(__builtins__))
-
-context['locals'] = locals
-
-
 def splat():
     # type: () -> Attrs
     return context
@@ -64,6 +54,7 @@ def br(n):
 # remove hiddens
 context = _filter_hidden(context)
 
+# only a few builtins, since registering all of them with every app slows down startup
 context['print'] = print
 context['vars'] = vars
 context['globals'] = globals
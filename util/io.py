@@ -13,6 +13,15 @@ def mkdir_if_not_exists(dir_path):
             raise
 
 
+def remove_if_exists(path):
+    # type: (str) -> None
+    try:
+        os.remove(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
 def sanitize_filename(filename):
     # type: (Union[str, unicode]) -> str
     illegal_chars = '/<>:"\'|?*'
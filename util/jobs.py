@@ -0,0 +1,147 @@
+from __future__ import print_function
+
+import threading
+import time
+from collections import deque
+from sys import stderr
+from threading import Thread
+
+from typing import Any, Dict, Hashable, Set, Tuple
+
+from util.types import Function
+
+
+class JobExecutor(object):
+    """
+    Bounded pool of background worker threads with a keyed job queue.
+
+    A job whose key is already queued or running is coalesced into it instead of being queued again,
+    and a job submitted while the queue is full is dropped.
+
+    :ivar num_workers: number of worker threads
+    :type num_workers: int
+
+    :ivar max_queue_size: max number of queued (not yet running) jobs
+    :type max_queue_size: int
+    """
+
+    DEFAULT_NUM_WORKERS = 2  # type: int
+    DEFAULT_MAX_QUEUE_SIZE = 32  # type: int
+
+    def __init__(self, num_workers=DEFAULT_NUM_WORKERS, max_queue_size=DEFAULT_MAX_QUEUE_SIZE,
+                 name='background'):
+        # type: (int, int, str) -> None
+        self.num_workers = num_workers
+        self.max_queue_size = max_queue_size
+        self.name = name
+        self._queue = deque()  # type: deque
+        self._pending_keys = set()  # type: Set[Hashable]
+        self._condition = threading.Condition()
+        self._shutdown = False
+
+        self._submitted = 0
+        self._coalesced = 0
+        self._dropped = 0
+        self._completed = 0
+        self._failed = 0
+        self._running = 0
+        self._total_run_time = 0.0
+        self._max_run_time = 0.0
+
+        self._workers = []
+        for i in xrange(num_workers):
+            worker = Thread(target=self._work, name='{}-{}'.format(name, i))
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def submit(self, key, runnable):
+        # type: (Hashable, Function) -> bool
+        """
+        Queue `runnable` to run in the background under `key`.
+        Return True if it was queued, False if it was coalesced or dropped.
+        """
+        with self._condition:
+            self._submitted += 1
+            if key in self._pending_keys:
+                self._coalesced += 1
+                return False
+            if self._shutdown or len(self._queue) >= self.max_queue_size:
+                self._dropped += 1
+                return False
+            self._pending_keys.add(key)
+            self._queue.append((key, runnable))
+            self._condition.notify()
+            return True
+
+    def _next_job(self):
+        # type: () -> Tuple[Hashable, Function]
+        with self._condition:
+            while not self._queue:
+                if self._shutdown:
+                    return None
+                self._condition.wait()
+            self._running += 1
+            return self._queue.popleft()
+
+    def _work(self):
+        # type: () -> None
+        while True:
+            job = self._next_job()
+            if job is None:
+                return
+            key, runnable = job
+            failed = False
+            start = time.time()
+            try:
+                runnable()
+            except Exception as e:
+                failed = True
+                print('background job {} failed: {}'.format(key, e), file=stderr)
+            run_time = time.time() - start
+            with self._condition:
+                self._pending_keys.discard(key)
+                self._running -= 1
+                if failed:
+                    self._failed += 1
+                else:
+                    self._completed += 1
+                self._total_run_time += run_time
+                self._max_run_time = max(self._max_run_time, run_time)
+                self._condition.notify_all()
+
+    def stats(self):
+        # type: () -> Dict[str, Any]
+        """Get queue depth, job counts and run times."""
+        with self._condition:
+            finished = self._completed + self._failed
+            return dict(
+                    queue_depth=len(self._queue),
+                    running=self._running,
+                    submitted=self._submitted,
+                    coalesced=self._coalesced,
+                    dropped=self._dropped,
+                    completed=self._completed,
+                    failed=self._failed,
+                    total_run_time=self._total_run_time,
+                    avg_run_time=self._total_run_time / finished if finished else 0.0,
+                    max_run_time=self._max_run_time,
+            )
+
+    def shutdown(self, wait=True):
+        # type: (bool) -> None
+        """
+        Stop accepting jobs, drop the queued ones (e.g. prefetches nobody will be served)
+        and stop the workers once their running jobs are done.
+        """
+        with self._condition:
+            self._shutdown = True
+            self._dropped += len(self._queue)
+            for key, runnable in self._queue:
+                self._pending_keys.discard(key)
+            self._queue.clear()
+            self._condition.notify_all()
+        if wait:
+            for worker in self._workers:
+                if worker is not threading.current_thread():
+                    worker.join()
@@ -0,0 +1,96 @@
+import os
+import threading
+
+from typing import Any, Callable, Type
+
+T = Type['T']
+
+
+class Lazy(object):
+    """
+    Proxy to the object created by `factory` the first time one of its attributes is used.
+
+    Use `resolve()` and `reset()` instead of methods, so they don't shadow the object's attributes.
+    """
+
+    def __init__(self, factory):
+        # type: (Callable[[], T]) -> None
+        object.__setattr__(self, '_factory', factory)
+        object.__setattr__(self, '_lock', threading.Lock())
+        object.__setattr__(self, '_obj', None)
+
+    def _is_stale(self):
+        # type: () -> bool
+        return self._obj is None
+
+    def _resolve(self):
+        # type: () -> T
+        if self._is_stale():
+            with self._lock:
+                if self._is_stale():
+                    object.__setattr__(self, '_obj', self._factory())
+                    self._on_created()
+        return self._obj
+
+    def _on_created(self):
+        # type: () -> None
+        pass
+
+    def _reset(self):
+        # type: () -> None
+        with self._lock:
+            object.__setattr__(self, '_obj', None)
+
+    def __getattr__(self, name):
+        # type: (str) -> Any
+        return getattr(self._resolve(), name)
+
+    def __setattr__(self, name, value):
+        # type: (str, Any) -> None
+        setattr(self._resolve(), name, value)
+
+    # special methods are looked up on the type, so they aren't proxied by __getattr__()
+
+    def __enter__(self):
+        # type: () -> Any
+        return self._resolve().__enter__()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # type: (type, BaseException, Any) -> Any
+        return self._resolve().__exit__(exc_type, exc_value, traceback)
+
+    def __repr__(self):
+        # type: () -> str
+        return '{}({!r})'.format(type(self).__name__, self._obj)
+
+
+class ProcessLocal(Lazy):
+    """
+    `Lazy` proxy whose object is created again in each process,
+    i.e. after a fork, so that connections, threads and locks are never shared across processes.
+    """
+
+    def __init__(self, factory):
+        # type: (Callable[[], T]) -> None
+        super(ProcessLocal, self).__init__(factory)
+        object.__setattr__(self, '_pid', None)
+
+    def _is_stale(self):
+        # type: () -> bool
+        return self._obj is None or self._pid != os.getpid()
+
+    def _on_created(self):
+        # type: () -> None
+        object.__setattr__(self, '_pid', os.getpid())
+
+
+def resolve(proxy):
+    # type: (Lazy) -> T
+    """Get the object of `proxy`, creating it if needed."""
+    return proxy._resolve()
+
+
+def reset(proxy):
+    # type: (Lazy) -> None
+    """Make `proxy` create a new object next time it's used."""
+    proxy._reset()
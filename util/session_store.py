@@ -0,0 +1,146 @@
+import threading
+import time
+from collections import OrderedDict
+
+from typing import Callable, Dict, Hashable, Tuple, Type, Union
+
+from util.db.db import Database
+
+V = Type['V']
+
+
+class SessionStore(object):
+    """
+    Abstract store of server-side session values, which expire after `ttl` seconds unused.
+
+    :ivar ttl: seconds an unused session lives for
+    :type ttl: float
+    """
+
+    DEFAULT_TTL = 24 * 60 * 60.0  # type: float
+
+    def __init__(self, ttl=DEFAULT_TTL):
+        # type: (float) -> None
+        self.ttl = ttl
+
+    def get(self, key):
+        # type: (Hashable) -> Union[V, None]
+        """Get the value of session `key`, or None if it doesn't exist or expired."""
+        raise NotImplementedError()
+
+    def put(self, key, value):
+        # type: (Hashable, V) -> None
+        """Set the value of session `key`, renewing its TTL."""
+        raise NotImplementedError()
+
+    def delete(self, key):
+        # type: (Hashable) -> None
+        raise NotImplementedError()
+
+    def close(self):
+        # type: () -> None
+        pass
+
+
+class MemorySessionStore(SessionStore):
+    """
+    In-process LRU session store holding at most `max_size` sessions.
+    Only usable with a single worker process.
+
+    :ivar max_size: max number of sessions, beyond which the least-recently-used are dropped
+    :type max_size: int
+    """
+
+    DEFAULT_MAX_SIZE = 10000  # type: int
+
+    def __init__(self, max_size=DEFAULT_MAX_SIZE, ttl=SessionStore.DEFAULT_TTL):
+        # type: (int, float) -> None
+        super(MemorySessionStore, self).__init__(ttl)
+        self.max_size = max_size
+        # key to (last used time, value), least-recently-used first
+        self._sessions = OrderedDict()  # type: Dict[Hashable, Tuple[float, V]]
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        # type: (Hashable) -> Union[V, None]
+        now = time.time()
+        with self._lock:
+            session = self._sessions.pop(key, None)
+            if session is None or now - session[0] > self.ttl:
+                return None
+            self._sessions[key] = (now, session[1])
+            return session[1]
+
+    def put(self, key, value):
+        # type: (Hashable, V) -> None
+        now = time.time()
+        with self._lock:
+            self._sessions.pop(key, None)
+            self._sessions[key] = (now, value)
+            while len(self._sessions) > self.max_size:
+                self._sessions.popitem(last=False)
+            # sessions are moved to the end when used, so expired ones are all at the start
+            while self._sessions:
+                old_key, (last_used, old_value) = next(self._sessions.iteritems())
+                if now - last_used <= self.ttl:
+                    break
+                del self._sessions[old_key]
+
+    def delete(self, key):
+        # type: (Hashable) -> None
+        with self._lock:
+            self._sessions.pop(key, None)
+
+
+class SqliteSessionStore(SessionStore):
+    """
+    Session store in a SQLite DB shared by all worker processes on a host.
+    Values are stored as strings converted by `serialize` and `deserialize`.
+    """
+
+    SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS sessions(
+        key TEXT PRIMARY KEY,
+        value BLOB NOT NULL,
+        expires REAL NOT NULL
+    )'''
+
+    # expired sessions are deleted every this many puts
+    PURGE_INTERVAL = 1000  # type: int
+
+    def __init__(self, path, serialize, deserialize, ttl=SessionStore.DEFAULT_TTL):
+        # type: (str, Callable[[V], str], Callable[[str], V], float) -> None
+        super(SqliteSessionStore, self).__init__(ttl)
+        self.serialize = serialize
+        self.deserialize = deserialize
+        self._db = Database(path)
+        with self._db.writing():
+            self._db.cursor.execute(SqliteSessionStore.SCHEMA)
+        self._num_puts = 0
+
+    def get(self, key):
+        # type: (Hashable) -> Union[V, None]
+        with self._db.reading():
+            self._db.cursor.execute('SELECT value FROM sessions WHERE key = ? AND expires > ?',
+                                    [str(key), time.time()])
+            result = self._db.cursor.fetchone()
+        return None if result is None else self.deserialize(str(result[0]))
+
+    def put(self, key, value):
+        # type: (Hashable, V) -> None
+        now = time.time()
+        with self._db.writing():
+            self._db.cursor.execute('INSERT OR REPLACE INTO sessions VALUES (?, ?, ?)',
+                                    [str(key), buffer(self.serialize(value)), now + self.ttl])
+            self._num_puts += 1
+            if self._num_puts % SqliteSessionStore.PURGE_INTERVAL == 0:
+                self._db.cursor.execute('DELETE FROM sessions WHERE expires <= ?', [now])
+
+    def delete(self, key):
+        # type: (Hashable) -> None
+        with self._db.writing():
+            self._db.cursor.execute('DELETE FROM sessions WHERE key = ?', [str(key)])
+
+    def close(self):
+        # type: () -> None
+        self._db.close()
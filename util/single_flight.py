@@ -0,0 +1,79 @@
+import sys
+import threading
+from contextlib import contextmanager
+
+from typing import Any, Callable, ContextManager, Dict, Hashable, Iterator, Type
+
+R = Type['R']
+
+
+class _Call(object):
+    """An in-flight call whose result is shared."""
+
+    def __init__(self):
+        # type: () -> None
+        self.done = threading.Event()
+        self.result = None  # type: R
+        self.exc_info = None  # type: tuple
+        # value of the leader's context, passed to callers joining
+        self.context_value = None  # type: Any
+
+
+@contextmanager
+def _no_context():
+    # type: () -> Iterator[None]
+    yield
+
+
+class SingleFlight(object):
+    """
+    Coalesces concurrent calls with the same key into a single call,
+    so callers arriving while it's in flight wait for and share its result.
+
+    The leading caller makes the call within `leader_context()`,
+    and each caller joining it calls `on_join()` with the value of that context,
+    e.g. to raise the priority of the call to that of the joining caller.
+    """
+
+    def __init__(self, leader_context=_no_context, on_join=None):
+        # type: (Callable[[], ContextManager], Callable[[Any], None]) -> None
+        self._leader_context = leader_context
+        self._on_join = on_join
+        self._calls = {}  # type: Dict[Hashable, _Call]
+        self._lock = threading.Lock()
+
+    def do(self, key, function):
+        # type: (Hashable, Callable[[], R]) -> R
+        """
+        Call `function` and return its result, unless a call with `key` is already in flight,
+        in which case wait for it and return its result instead (or raise its exception).
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = self._calls[key] = _Call()
+                context = self._leader_context()  # type: ContextManager
+                # entered under the lock, so every caller joining gets its value
+                call.context_value = context.__enter__()
+            elif self._on_join is not None:
+                self._on_join(call.context_value)
+
+        if not is_leader:
+            call.done.wait()
+            if call.exc_info is not None:
+                exc_type, exc_value, traceback = call.exc_info
+                raise exc_type, exc_value, traceback
+            return call.result
+
+        try:
+            call.result = function()
+        except:
+            call.exc_info = sys.exc_info()
+            raise
+        finally:
+            context.__exit__(None, None, None)
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
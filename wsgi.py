@@ -0,0 +1,3 @@
+from core.app import configure_app
+
+app = configure_app()